@@ -4,11 +4,25 @@ from sparrow.ext import CloudDataPlugin
 from sparrow.import_helpers import SparrowImportError
 from sparrow.cli.util import with_app, with_database
 from textwrap import wrap
+from multiprocessing import get_context
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
-from .extract_datatable import extract_s3_object
+from .extract_datatable import (
+    extract_s3_object, extract_body, insert_data_file, needs_extraction, SpooledBody)
+from .pipeline import completed, ordered_results
+from .manifest import check_manifest
 from .laserchron_importer import LaserchronImporter
+from .parallel_import import import_parallel
+from .lab_views import refresh_lab_views
+from .query_plans import check_query_plans
 from .sample_names import list_sample_names
-from .cli import import_laserchron, list_samples
+from .datatable_cache import migrate_legacy_rows, iter_data_files, iter_data_file_batches
+from .cli import (
+    import_laserchron, list_samples, migrate_cache, check_indexes, import_agecalc_ml)
+from .benchmarks import benchmark_laserchron
+from .failures import skip_known_failures, known_failure_hashes
+from . import agecalc_ml
+from .profiling import ImportProfile, NullProfile, timed_call
 
 class LaserChronDataPlugin(SparrowPlugin):
 
@@ -16,59 +30,238 @@ class LaserChronDataPlugin(SparrowPlugin):
     dependencies = ["cloud-data"]
     stop_on_error = False
     redo = False
+    profile = NullProfile()
 
-    def import_object(self, meta):
+    def import_object(self, meta, inst=None):
         db = self.app.database
         # Don't download body unless we really need to
         body = None
-        inst = self.cloud._instance_for_meta(meta)
         if inst is None or self.redo:
             try:
-                body = self.cloud.get_body(meta['Key'])
-                # Extract s3 object to a CSV file
-                inst, extracted = extract_s3_object(db, meta, body, redo=self.redo)
-                db.session.commit()
+                with self.profile.file(meta['Key'], name="extract") as stage:
+                    stage['bytes'] = meta.get('Size')
+                    body = self.cloud.get_body(meta['Key'])
+                    # Extract s3 object to a CSV file
+                    inst, extracted = extract_s3_object(db, meta, body,
+                        redo=self.redo, profile=self.profile)
+                    with self.profile.stage("commit"):
+                        db.session.commit()
             except (SparrowImportError, NotImplementedError) as e:
                 if self.stop_on_error:
                     raise e
                 db.session.rollback()
         return inst
 
-    def process_objects(self, only_untracked=True, verbose=False):
+    def fetch_object(self, meta):
+        """Download and hash an object body (runs on a worker thread)"""
+        with self.profile.stage("fetch", nbytes=meta.get('Size'), file=meta['Key']):
+            return SpooledBody(self.cloud.get_body(meta['Key']))
+
+    def process_objects(self, only_untracked=True, verbose=False,
+            jobs=1, download_concurrency=1):
         self.cloud = self.app.plugins.get("cloud-data")
-        for obj in self.cloud.iterate_objects(only_untracked=only_untracked):
-            yield self.import_object(obj)
+        objects = self.cloud.iterate_objects(only_untracked=only_untracked)
+        # Check the listing against extracted files before fetching any bodies
+        objects = check_manifest(self.app.database, objects)
+        if jobs <= 1 and download_concurrency <= 1:
+            for obj, inst in objects:
+                yield self.import_object(obj, inst)
+            return
+        yield from self.process_objects_concurrently(
+            objects,
+            jobs=max(jobs, 1),
+            download_concurrency=max(download_concurrency, 1))
+
+    def process_objects_concurrently(self, objects, jobs=1, download_concurrency=1):
+        """
+        Download object bodies on a thread pool and parse workbooks on a process
+        pool. Database lookups and writes happen on this thread only, and
+        records are yielded in the same order as `objects`, an iterable of
+        `(meta, inst)` pairs from `check_manifest`.
+        """
+        db = self.app.database
+        data_file = db.model.data_file
+        # Keep enough work queued to saturate both pools without holding
+        # an unbounded number of object bodies in memory.
+        window = 2*max(jobs, download_concurrency)
+
+        # Bodies that have been fetched but not yet written, so that their
+        # spool files are cleaned up if anything fails along the way
+        open_bodies = set()
+
+        def release(body):
+            body.close()
+            open_bodies.discard(body)
+
+        def fetch_tasks():
+            for meta, inst in objects:
+                # Don't download body unless we really need to
+                if inst is not None and not self.redo:
+                    yield (meta, inst), completed()
+                else:
+                    yield (meta, inst), fetchers.submit(self.fetch_object, meta)
+
+        def parse_tasks():
+            for (meta, inst), fetched in ordered_results(fetch_tasks(), window):
+                if fetched is None:
+                    yield (meta, None, inst), completed()
+                    continue
+                open_bodies.add(fetched)
+                secho(str(meta['Key']), dim=True)
+                rec = db.get(data_file, fetched.hash)
+                if rec is not None and not self.redo and not needs_extraction(rec):
+                    secho("Already extracted", fg='green', dim=True)
+                    release(fetched)
+                    yield (meta, None, rec), completed()
+                    continue
+                # Parse times are measured in the worker and recorded here
+                future = parsers.submit(timed_call, extract_body, meta['Key'], fetched.payload())
+                yield (meta, fetched, rec), future
+
+        # Parsers are started from a fork server rather than forked from this
+        # process, which has fetcher threads (and their locks) running.
+        try:
+            with ProcessPoolExecutor(jobs, mp_context=get_context("forkserver")) as parsers, \
+                 ThreadPoolExecutor(download_concurrency) as fetchers:
+                for (meta, body, inst), extracted in ordered_results(parse_tasks(), window):
+                    if body is None:
+                        yield inst
+                        continue
+                    release(body)
+                    extracted, timing = extracted
+                    self.profile.add("parse", timing, nbytes=body.size, file=meta['Key'])
+                    yield self.write_object(meta, body.hash, *extracted, inst=inst)
+        finally:
+            for body in open_bodies:
+                body.close()
+
+    def write_object(self, meta, file_hash, csv_data, error=None, inst=None):
+        """
+        Apply a parsed object to the database (runs on the calling thread).
+        Like `import_object`, returns the record that existed before extraction.
+        """
+        db = self.app.database
+        if error is not None:
+            secho(error, fg='red', dim=True)
+        nbytes = None if csv_data is None else len(csv_data)
+        try:
+            with self.profile.stage("write_data_file", nbytes=nbytes, file=meta['Key']):
+                insert_data_file(db, meta, file_hash, csv_data, error=error)
+                db.session.commit()
+        except (SparrowImportError, NotImplementedError) as e:
+            if self.stop_on_error:
+                raise e
+            db.session.rollback()
+        # Newly-extracted files are picked up by the next import,
+        # consistent with serial extraction.
+        return inst
 
     def import_data(self, basename=None, stop_on_error=False,
-            download=False, normalize=True, redo=False, verbose=False):
+            download=False, normalize=True, redo=False, verbose=False,
+            jobs=1, download_concurrency=1, bulk=True, workers=1,
+            profile=None, profile_slowest=0, retry_failed=False):
         """
-        Import LaserChron files
+        Import LaserChron files. Files that failed to import with the current
+        importer version are skipped unless `retry_failed` is set. If a `profile`
+        path is given, the time spent in each stage is written to it, along with
+        cProfile dumps for the `profile_slowest` slowest files.
         """
         db = self.app.database
 
         self.stop_on_error = stop_on_error
         self.redo = redo
+        if profile is not None:
+            self.profile = ImportProfile(n_slowest=profile_slowest)
 
         importer = LaserchronImporter(self.app, verbose=verbose)
-        if normalize and not basename:
-            if download:
-                iterator = self.process_objects(only_untracked=False)
+        importer.bulk_insert = bulk
+        importer.profile = self.profile
+        try:
+            if normalize and not basename and workers > 1:
+                if download:
+                    # Extract new files first, then import everything in parallel
+                    for _ in self.process_objects(
+                            only_untracked=False,
+                            jobs=jobs,
+                            download_concurrency=download_concurrency):
+                        pass
+                q = db.session.query(db.model.data_file)
+                if not retry_failed:
+                    q = skip_known_failures(db, q)
+                import_parallel(self.app, q, workers=workers, redo=redo, bulk=bulk,
+                    profile=self.profile)
+            elif normalize and not basename:
+                if download:
+                    iterator = self.process_objects(
+                        only_untracked=False,
+                        jobs=jobs,
+                        download_concurrency=download_concurrency)
+                    if not retry_failed:
+                        failed = known_failure_hashes(db)
+                        iterator = (rec for rec in iterator
+                                    if rec is None or str(rec.file_hash) not in failed)
+                else:
+                    # Just use files that are already tracked in the data files object
+                    q = db.session.query(db.model.data_file)
+                    if not retry_failed:
+                        q = skip_known_failures(db, q)
+                    iterator = iter_data_files(db, q)
+                importer.iter_records(iterator, redo=redo)
+                importer.lookups.report()
+            elif basename:
+                importer.import_one(basename)
+                importer.lookups.report()
             else:
-                # Just use files that are already tracked in the data files object
-                iterator = db.session.query(db.model.data_file)
-            importer.iter_records(iterator, redo=redo)
-        elif basename:
-            importer.import_one(basename)
-        else:
-            list(self.process_objects(only_untracked=True, verbose=True))
+                list(self.process_objects(
+                    only_untracked=True,
+                    verbose=True,
+                    jobs=jobs,
+                    download_concurrency=download_concurrency))
+        finally:
+            importer.close()
+
+        if normalize or basename:
+            with self.profile.stage("refresh_lab_views"):
+                refresh_lab_views(db)
+
+        if profile is not None:
+            self.profile.report()
+            self.profile.write(profile)
+
+    def import_agecalc_ml(self, files, project=None, chunk_size=500, standards=False):
+        """
+        Import NuAgeCalc MATLAB exports
+        """
+        agecalc_ml.import_agecalc_ml(self.app, files,
+            project=project, chunk_size=chunk_size, standards=standards)
+        refresh_lab_views(self.app.database)
 
     def list_samples(self, verbose=False):
         db = self.app.database
-        importer = LaserchronImporter(db)
         data_file = db.model.data_file
-        iterator = db.session.query(data_file).filter(data_file.csv_data != None)
-        list_sample_names(iterator, verbose=verbose)
+        q = db.session.query(data_file).filter(data_file.csv_data != None)
+        for batch in iter_data_file_batches(db, q):
+            list_sample_names(batch, verbose=verbose)
+            # Keep normalized tables cached by the listing, and release
+            # this batch's tables before loading the next
+            db.session.commit()
+            db.session.expunge_all()
+
+    def migrate_cache(self, batch_size=100):
+        db = self.app.database
+        n = migrate_legacy_rows(db, batch_size=batch_size)
+        secho(f"Migrated {n} data tables to the binary cache format", fg='green')
+
+    def check_indexes(self, force_index=True):
+        failed = check_query_plans(self.app.database, force_index=force_index)
+        if len(failed) > 0:
+            secho(f"{len(failed)} queries are not using their expected indexes", fg='red')
+        return len(failed) == 0
 
     def on_setup_cli(self, cli):
         cli.add_command(import_laserchron)
         cli.add_command(list_samples)
+        cli.add_command(migrate_cache)
+        cli.add_command(check_indexes)
+        cli.add_command(benchmark_laserchron)
+        cli.add_command(import_agecalc_ml)
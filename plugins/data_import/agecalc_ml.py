@@ -1,22 +1,238 @@
-from sys import exit
-from os import environ, listdir, path
+"""
+Bulk import of NuAgeCalc MATLAB session exports.
+
+NuAgeCalc saves its state as a struct `H`, with one entry per spot in each
+of its reduced-data fields. MATLAB v7.3 files are HDF5, and fields are read
+lazily with h5py, one slice of spots at a time. Older files are read with
+scipy, which loads the struct at once. Spot names are read up front, since
+sample names are resolved over all of a file's spots.
+"""
+from pathlib import Path
 from datetime import datetime
-from click import command, option, echo, secho, style
-from IPython import embed
-from h5py import File
+from contextlib import contextmanager
+from click import secho
+from pandas import DataFrame, MultiIndex, Series
+from h5py import File, is_hdf5
+from scipy.io import loadmat
+import numpy as N
+
+from sparrow.import_helpers import SparrowImportError
+
+from .laserchron_importer import LaserchronImporter, long_datums, extract_datetime, nan_to_none
+from .sample_names import assign_sample_names, session_indexes, delimiters
+from .lab_views import update_age_buckets
+
+# Normalized column -> (field of `H`, unit). Columns are named as
+# `normalize_data` names the matching data table columns.
+columns = {
+    "207Pb_235U": ("ratio75", "ratio"),
+    "207Pb_235U_error": ("ratio75_err", "%"),
+    "206Pb_238U": ("ratio68", "ratio"),
+    "206Pb_238U_error": ("err68m", "%"),
+    "error_corr": ("rho", "dimensionless"),
+    "age_206Pb_238U": ("Age68", "Ma"),
+    "age_206Pb_238U_error": ("Age68_err", "Ma"),
+    "age_206Pb_207Pb": ("Age67", "Ma"),
+    "age_206Pb_207Pb_error": ("Age67_err", "Ma"),
+    "age_208Pb_232Th": ("Age82", "Ma"),
+    "age_208Pb_232Th_error": ("Age82_err", "Ma"),
+    "best_age": ("Best_Age", "Ma"),
+}
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        # Empty cells and placeholders such as 'NA'
+        return N.nan
+
+
+class HDF5Export(object):
+    """Fields of a MATLAB v7.3 export, read from HDF5 on demand"""
+    def __init__(self, fn):
+        self.file = File(fn, "r")
+        self.H = self.file["H"]
+        self.n_spots = self.H["sample"].size
+
+    def _value(self, ds):
+        if ds.attrs.get("MATLAB_empty", 0):
+            return None
+        arr = ds[()]
+        if ds.attrs.get("MATLAB_class", b"") == b"char":
+            return "".join(chr(c) for c in arr.ravel())
+        return arr.ravel()[0]
+
+    def column(self, field, start, stop):
+        ds = self.H[field]
+        # MATLAB arrays are stored transposed, so a column vector of spots
+        # is along the last axis, and a row vector along the first
+        if ds.ndim > 1 and ds.shape[-1] == 1:
+            values = ds[start:stop, ...].ravel()
+        else:
+            values = ds[..., start:stop].ravel()
+        if ds.dtype.kind == 'O':
+            # Cell arrays hold a reference to a dataset for each spot
+            return [self._value(self.file[ref]) for ref in values]
+        return values
+
+    def close(self):
+        self.file.close()
+
+
+class MatV5Export(object):
+    """Fields of a MATLAB v5 export, loaded with scipy"""
+    def __init__(self, fn):
+        mat = loadmat(fn, variable_names=["H"], squeeze_me=True,
+                      struct_as_record=False, chars_as_strings=True)
+        self.H = mat["H"]
+        self.n_spots = N.size(self.H.sample)
+
+    def column(self, field, start, stop):
+        values = N.atleast_1d(getattr(self.H, field))[start:stop]
+        # Empty cells are loaded as empty arrays
+        return [None if isinstance(v, N.ndarray) and v.size == 0 else v
+                for v in values]
+
+    def close(self):
+        pass
+
+
+@contextmanager
+def open_export(fn):
+    export = HDF5Export(fn) if is_hdf5(str(fn)) else MatV5Export(fn)
+    try:
+        yield export
+    finally:
+        export.close()
+
+
+def spot_names(export):
+    """
+    Sample and analysis names and session indexes of all spots in an export,
+    following the same rules as analysis ids in data tables. These are
+    resolved over all spots at once, since whether a sample falls back to
+    whole ids depends on all of its spots.
+    """
+    analysis = Series([str(v).strip(delimiters) for v in export.column("sample", 0, export.n_spots)],
+                      dtype=object)
+    sample_name, analysis_name = assign_sample_names(analysis)
+    return DataFrame({
+        "sample_name": sample_name,
+        "analysis_name": analysis_name,
+        "session_index": session_indexes(analysis_name)})
+
+
+def spot_table(export, names, start, stop):
+    """
+    Reduced values for a slice of spots, as a data table indexed like the
+    output of `generalize_samples`, along with its column metadata. `names`
+    are the `spot_names` of the export. Standards and rejected spots are
+    flagged in the `standard` and `rejected` columns.
+    """
+    df = DataFrame({c: [_number(v) for v in export.column(field, start, stop)]
+                    for c, (field, unit) in columns.items()})
+    df.index = MultiIndex.from_frame(names.iloc[start:stop].reset_index(drop=True))
+
+    standard = N.zeros(len(df), dtype=bool)
+    for field in ("STD1_idx", "STD2_idx"):
+        standard |= N.asarray([_number(v) == 1 for v in export.column(field, start, stop)])
+    status = export.column("current_status", start, stop)
+    df['standard'] = standard
+    df['rejected'] = [s != "Accepted" for s in status]
+
+    meta = DataFrame([{c: unit for c, (field, unit) in columns.items()}], index=["Unit"])
+    return df, meta
+
+
+class AgeCalcMatImporter(LaserchronImporter):
+    """
+    Import reduced spot data from NuAgeCalc MATLAB exports. Each sample in
+    a file gets its own session, as for data tables.
+    """
+    chunk_size = 500
+    include_standards = False
+
+    def import_file(self, fn, project_name=None):
+        fn = Path(fn)
+        if project_name is None:
+            project_name = fn.parent.name
+        date = extract_datetime(str(fn))
+        if date is None:
+            # Dates are required, as for data tables
+            date = datetime.min
+
+        n_spots = 0
+        with open_export(fn) as export:
+            with self.profile.stage("spot_names", rows=export.n_spots):
+                names = spot_names(export)
+            for start in range(0, export.n_spots, self.chunk_size):
+                stop = min(start+self.chunk_size, export.n_spots)
+                with self.profile.stage("read_mat", rows=stop-start):
+                    df, meta = spot_table(export, names, start, stop)
+                if not self.include_standards:
+                    df = df[~df['standard']]
+                # Spots without a sample name are imported into a session
+                # without a sample, as for data tables
+                for sample_name, sample_df in df.groupby(level=0, sort=False, dropna=False):
+                    if len(sample_df) == 0:
+                        continue
+                    self.import_spots(sample_df, meta, project_name, date)
+                n_spots += len(df)
+        return n_spots
+
+    def import_spots(self, df, meta, project_name, date):
+        df = df[~df.index.duplicated(keep='first')]
+        rejected = df['rejected'].values.astype(bool)
+        df = df.drop(columns=['standard', 'rejected'])
+
+        with self.profile.stage("long_datums", rows=len(df)):
+            datums = long_datums(df, meta)
+        if len(datums) == 0:
+            # None of the spots have values
+            return None
+        # Ages of rejected spots are never accepted
+        datums.loc[rejected[datums['row'].values.astype(int)], 'is_accepted'] = False
+
+        project_id = self.project_id(project_name)
+        sample_name = nan_to_none(df.index[0][0])
+        sample_id = None
+        if sample_name is not None:
+            sample_id = self.sample_id(sample_name)
+        session = self.db.get_or_create(
+            self.m.session,
+            project_id=project_id,
+            sample_id=sample_id,
+            date=date)
+        self.db.session.add(session)
+        self.db.session.flush()
+
+        with self.profile.stage("insert_datums", rows=len(datums)):
+            analysis_ids = self.bulk_import_analyses(df, session)
+            self.bulk_import_datums(analysis_ids, datums)
+
+        self.db.session.flush()
+        update_age_buckets(self.db, session.id)
+        return session
 
-from sparrow.database import get_or_create
-from sparrow.util import relative_path
 
-def import_agecalc_ml(test=True):
+def import_agecalc_ml(app, files, project=None, chunk_size=500, standards=False):
     """
-    Import Matlab save file for E2 in bulk.
+    Import NuAgeCalc MATLAB exports, committing after each file.
     """
-    if not test:
-        echo(f"Only test data supported for now")
-        return
-    fn = relative_path(__file__,'../test-data/Test_E2_Export.mat')
-    print(fn)
-    # Load file as a pre-7.3 matlab file
-    mat = loadmat(fn)
-    embed()
+    db = app.database
+    importer = AgeCalcMatImporter(app)
+    importer.chunk_size = chunk_size
+    importer.include_standards = standards
+    try:
+        for fn in files:
+            secho(str(fn), dim=True)
+            try:
+                n_spots = importer.import_file(fn, project_name=project)
+                db.session.commit()
+                secho(f"Imported {n_spots} spots", fg='green')
+            except (SparrowImportError, KeyError, IndexError, OSError, ValueError) as err:
+                db.session.rollback()
+                secho(f"{type(err).__name__}: {err}", fg='red')
+    finally:
+        importer.close()
@@ -0,0 +1,268 @@
+"""
+Benchmarks for the LaserChron import pipeline.
+
+The `pipeline` benchmark times each import stage over a synthetic archive,
+and can save its results as a baseline or fail when a stage is slower than
+a saved baseline.
+"""
+import json
+import tracemalloc
+from os import devnull
+from contextlib import redirect_stdout, redirect_stderr
+from datetime import datetime
+from hashlib import md5
+from io import BytesIO, StringIO
+from pathlib import Path
+from time import perf_counter
+from click import group, option, echo, style, get_current_context, UsageError
+from click import Path as PathType
+
+from sparrow.import_helpers import SparrowImportError
+from sparrow.cli.util import with_app
+
+from .extract_datatable import (
+    SpooledBody, encode_datatable, insert_data_file)
+from .laserchron_importer import (
+    LaserchronImporter, extract_datetime, segment_datetime, range_regex,
+    _find_datetime)
+from .datatable_cache import encode_frame, decode_frame
+from .normalize_data import normalize_data
+from .sample_names import generalize_samples
+from .profiling import ImportProfile
+from .synthetic import load_templates, synthetic_archive, fake_hash
+
+test_data = Path(__file__).parent / "test-data"
+
+
+def peak_memory(func, *args, **kwargs):
+    """Peak memory (in bytes) allocated by Python while running `func`"""
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def _extract(infile, stem):
+    try:
+        encode_datatable(infile, stem=stem)
+    except SparrowImportError:
+        # Matlab exports and files without a data table still
+        # exercise the download and hashing steps.
+        pass
+
+
+def buffered_extraction(fn):
+    """Extraction as done before streaming: the body is copied into memory,
+    hashed, and copied again to hand to the workbook reader."""
+    with open(fn, 'rb') as f:
+        fobj = BytesIO(f.read())
+    md5(fobj.read()).hexdigest()
+    fobj.seek(0)
+    _extract(BytesIO(fobj.read()), fn.stem)
+
+
+def streaming_extraction(fn, max_memory=None):
+    kwargs = {}
+    if max_memory is not None:
+        kwargs['max_memory'] = max_memory
+    with open(fn, 'rb') as f, SpooledBody(f, stem=fn.stem, **kwargs) as body:
+        _extract(body, fn.stem)
+
+
+def _mb(n):
+    return f"{n/1e6:8.2f} MB"
+
+
+@group(name="benchmark-laserchron")
+def benchmark_laserchron():
+    """
+    Benchmark parts of the LaserChron import pipeline
+    """
+    pass
+
+
+@benchmark_laserchron.command(name="memory")
+@option('--max-memory', type=int, default=None,
+        help="Size (in bytes) above which bodies are spooled to disk")
+def memory(max_memory=None):
+    """
+    Peak memory used to extract the bundled test files
+    """
+    echo(style(f"{'file':40} {'size':>11} {'buffered':>11} {'streaming':>11}", bold=True))
+    for fn in sorted(test_data.iterdir()):
+        if not fn.is_file():
+            continue
+        size = fn.stat().st_size
+        buffered = peak_memory(buffered_extraction, fn)
+        streaming = peak_memory(streaming_extraction, fn, max_memory=max_memory)
+        echo(f"{fn.name:40} {_mb(size)} {_mb(buffered)} {_mb(streaming)}")
+
+
+def datefinder_extract_datetime(st):
+    """Date extraction as done before caching, using only datefinder"""
+    for pathseg in st.split("/")[::-1]:
+        without_ranges = range_regex.sub(r"\2 ", pathseg)
+        res = _find_datetime(without_ranges)
+        if res is None:
+            res = _find_datetime(pathseg)
+        if res is not None:
+            return res[0]
+    return None
+
+
+def _time_each(func, items, repeat=1):
+    start = perf_counter()
+    with redirect_stdout(StringIO()):
+        for i in range(repeat):
+            results = [func(item) for item in items]
+    return perf_counter()-start, results
+
+
+@benchmark_laserchron.command(name="dates")
+@option('--repeat', type=int, default=3)
+@with_app
+def dates(app, repeat=3):
+    """
+    Date extraction over the paths of tracked data files
+    """
+    db = app.database
+    data_file = db.model.data_file
+    q = db.session.query(data_file.file_path).filter(data_file.file_path != None)
+    paths = [p for p, in q]
+
+    t0, expected = _time_each(datefinder_extract_datetime, paths, repeat)
+    segment_datetime.cache_clear()
+    t1, results = _time_each(extract_datetime, paths, repeat)
+
+    n_diff = sum(a != b for a, b in zip(expected, results))
+    echo(f"{len(paths)} paths x {repeat}")
+    echo(f"datefinder: {t0:8.3f} s")
+    echo(f"cached:     {t1:8.3f} s  ({segment_datetime.cache_info()})")
+    echo(style(f"{n_diff} paths with different dates", fg='red' if n_diff else 'green'))
+
+
+def run_pipeline(app, templates, n_files, min_spots=50, max_spots=1000,
+        seed=0, session_import=False):
+    """
+    Time the stages of the import pipeline over a synthetic archive.
+    Sessions are imported within a transaction that is rolled back
+    after each file.
+    """
+    db = app.database
+    profile = ImportProfile()
+    importer = None
+    if session_import:
+        importer = LaserchronImporter(app)
+        importer.bulk_insert = True
+        # Each file is rolled back here, so failures can't be committed
+        importer.cache_failures = False
+
+    # Workbooks can't be synthesized, so the fixtures stand in for
+    # the cost of reading Excel files.
+    for fn, _, _ in templates:
+        with profile.stage("encode_datatable", nbytes=fn.stat().st_size, file=fn.name):
+            encode_datatable(fn)
+
+    archive = synthetic_archive(templates, n_files,
+        min_spots=min_spots, max_spots=max_spots, seed=seed)
+    for key, df in archive:
+        profile.current_file = key
+        with profile.stage("encode_frame", rows=len(df)) as stage:
+            blob = encode_frame(df)
+            stage['bytes'] = len(blob)
+        with profile.stage("decode_frame", rows=len(df), nbytes=len(blob)):
+            df = decode_frame(blob)
+        try:
+            with profile.stage("normalize_data", rows=len(df)):
+                data, meta = normalize_data(df)
+            data.index.name = 'analysis'
+            with profile.stage("generalize_samples", rows=len(data)):
+                generalize_samples(data)
+        except SparrowImportError:
+            continue
+
+        if importer is None:
+            continue
+        meta = dict(Key=key, ETag=fake_hash(key), LastModified=datetime(2020, 1, 1))
+        try:
+            insert_data_file(db, meta, fake_hash(key), blob)
+            rec = db.get(db.model.data_file, fake_hash(key))
+            with profile.stage("import_session", rows=len(data)):
+                list(importer.import_datafile(None, rec))
+        except SparrowImportError:
+            pass
+        finally:
+            db.session.rollback()
+    profile.current_file = None
+    if importer is not None:
+        importer.close()
+    return profile
+
+
+def compare_baseline(baseline, stages, tolerance):
+    """Stages whose wall time grew by more than `tolerance` over the baseline"""
+    current = {t['stage']: t for t in stages}
+    regressions = []
+    echo(style(f"{'stage':24} {'baseline (s)':>13} {'current (s)':>13} {'change':>8}", bold=True))
+    for t in baseline:
+        if t['stage'] not in current:
+            continue
+        wall = current[t['stage']]['wall']
+        change = wall/t['wall'] - 1 if t['wall'] > 0 else 0
+        failed = change > tolerance
+        if failed:
+            regressions.append(t['stage'])
+        echo(f"{t['stage']:24} {t['wall']:13.3f} {wall:13.3f} "
+             + style(f"{change:+8.1%}", fg='red' if failed else 'green'))
+    return regressions
+
+
+@benchmark_laserchron.command(name="pipeline")
+@option('--files', type=int, default=100, help="Number of synthetic data files")
+@option('--min-spots', type=int, default=50)
+@option('--max-spots', type=int, default=1000)
+@option('--seed', type=int, default=0)
+@option('--session-import/--no-session-import', default=True,
+        help="Also time importing sessions into the database (rolled back)")
+@option('--save', type=PathType(dir_okay=False), default=None,
+        help="Save the results as a baseline")
+@option('--compare', type=PathType(exists=True, dir_okay=False), default=None,
+        help="Fail if any stage is slower than in this baseline")
+@option('--tolerance', type=float, default=0.25,
+        help="Allowed fractional slowdown before a stage counts as a regression")
+@with_app
+def pipeline(app, files=100, min_spots=50, max_spots=1000, seed=0,
+        session_import=True, save=None, compare=None, tolerance=0.25):
+    """
+    Import pipeline stages over a synthetic archive built from the test data
+    """
+    params = dict(files=files, min_spots=min_spots, max_spots=max_spots,
+        seed=seed, session_import=session_import)
+
+    baseline = None
+    if compare is not None:
+        baseline = json.loads(Path(compare).read_text())
+        if baseline['parameters'] != params:
+            raise UsageError(f"Baseline was run with different parameters: {baseline['parameters']}")
+
+    templates = load_templates(test_data)
+    if len(templates) == 0:
+        raise UsageError("No readable data tables in test data")
+
+    with open(devnull, "w") as f, redirect_stdout(f), redirect_stderr(f):
+        profile = run_pipeline(app, templates, **params)
+    profile.report()
+    stages = profile.summary()
+
+    if save is not None:
+        Path(save).write_text(json.dumps(dict(parameters=params, stages=stages), indent=2))
+        echo(f"Saved baseline to {save}")
+
+    if baseline is not None:
+        regressions = compare_baseline(baseline['stages'], stages, tolerance)
+        if len(regressions) > 0:
+            echo(style(f"{len(regressions)} stages regressed: {', '.join(regressions)}", fg='red'))
+            get_current_context().exit(1)
@@ -1,4 +1,4 @@
-from click import command, option, argument
+from click import command, option, argument, get_current_context, Path
 from sparrow.cli.util import with_app
 # Right now the command-line application is relatively
 # loosely coupled to the importer plugin, which is probably
@@ -13,6 +13,20 @@ from sparrow.cli.util import with_app
 @option('--download/--no-download', default=True)
 @option('--normalize/--no-normalize', default=True)
 @option('--redo', default=False, is_flag=True)
+@option('--jobs', '-j', type=int, default=1,
+        help="Number of processes used to parse workbooks")
+@option('--download-concurrency', type=int, default=1,
+        help="Number of concurrent object downloads")
+@option('--bulk/--no-bulk', default=True,
+        help="Write analyses and datums with bulk inserts")
+@option('--workers', type=int, default=1,
+        help="Number of processes used to import data files")
+@option('--profile', type=Path(dir_okay=False), default=None,
+        help="Write per-stage timings to a JSON (or .csv) report")
+@option('--profile-slowest', type=int, default=0,
+        help="Also write cProfile dumps for this many of the slowest files")
+@option('--retry-failed', is_flag=True, default=False,
+        help="Retry files that failed to import with the current importer")
 @argument('basename', required=False, nargs=-1)
 @with_app
 def import_laserchron(app, **kwargs):
@@ -31,3 +45,44 @@ def list_samples(app, **kwargs):
     """
     plugin = app.plugins.get("laserchron-data")
     plugin.list_samples(**kwargs)
+
+
+@command(name="migrate-laserchron-cache")
+@option('--batch-size', type=int, default=100)
+@with_app
+def migrate_cache(app, **kwargs):
+    """
+    Rewrite cached CSV data tables in the binary cache format
+    """
+    plugin = app.plugins.get("laserchron-data")
+    plugin.migrate_cache(**kwargs)
+
+
+@command(name="check-laserchron-indexes")
+@option('--force-index/--no-force-index', default=True,
+        help="Disable sequential scans so that usable indexes are always chosen")
+@with_app
+def check_indexes(app, **kwargs):
+    """
+    Check that query plans use the indexes the importer relies on
+    """
+    plugin = app.plugins.get("laserchron-data")
+    if not plugin.check_indexes(**kwargs):
+        get_current_context().exit(1)
+
+
+@command(name="import-agecalc-ml")
+@option('--project', default=None,
+        help="Project name (defaults to the name of each file's folder)")
+@option('--chunk-size', type=int, default=500,
+        help="Number of spots read and imported at a time")
+@option('--standards', is_flag=True, default=False,
+        help="Also import analyses of standards")
+@argument('files', type=Path(exists=True, dir_okay=False), nargs=-1, required=True)
+@with_app
+def import_agecalc_ml(app, **kwargs):
+    """
+    Import NuAgeCalc MATLAB (.mat) session exports
+    """
+    plugin = app.plugins.get("laserchron-data")
+    plugin.import_agecalc_ml(**kwargs)
@@ -0,0 +1,187 @@
+"""
+Binary cache format for extracted data tables, stored in `data_file.csv_data`.
+
+Tables are stored as compressed Arrow IPC (Feather v2) bytes behind a short
+header that identifies the format version. Rows written before this format
+was introduced hold uncompressed CSV text, and are still read transparently.
+
+Normalized `(data, meta)` pairs are cached in `data_file.normalized_data`
+using the same container with a different magic number.
+"""
+import json
+from io import StringIO
+from click import secho
+from pandas import read_csv, isnull, DataFrame
+from pyarrow import BufferReader, BufferOutputStream, Table, feather
+from sqlalchemy import func
+from sqlalchemy.orm import defer
+import numpy as N
+
+MAGIC = b"LCDT"
+VERSION = 1
+HEADER = MAGIC + bytes([VERSION])
+NORMALIZED_MAGIC = b"LCNT"
+NORMALIZED_HEADER = NORMALIZED_MAGIC + bytes([VERSION])
+COMPRESSION = "zstd"
+
+
+def is_legacy(blob):
+    """Whether a cached table was stored as CSV text"""
+    return bytes(blob[:len(MAGIC)]) != MAGIC
+
+
+def _storable(df):
+    """
+    Prepare a data table for storage in Arrow format. Column names are
+    positional, and mixed columns are stored as text, which matches what
+    we used to get back from a CSV round trip.
+    """
+    df = df.reset_index(drop=True)
+    df.columns = [str(c) for c in df.columns]
+    for c in df.columns:
+        col = df[c]
+        if col.dtype == object:
+            df[c] = col.where(col.isnull(), col.astype(str))
+    return df
+
+
+def _write_table(header, tbl):
+    sink = BufferOutputStream()
+    feather.write_feather(tbl, sink, compression=COMPRESSION)
+    return header + sink.getvalue().to_pybytes()
+
+
+def _read_table(header, blob):
+    version = blob[len(header)-1]
+    if version != VERSION:
+        raise ValueError(f"Unsupported data table cache version {version}")
+    buf = memoryview(blob)[len(header):]
+    return feather.read_table(BufferReader(buf))
+
+
+def encode_frame(df):
+    """Encode a raw data table to its cached binary representation"""
+    tbl = Table.from_pandas(_storable(df), preserve_index=False)
+    return _write_table(HEADER, tbl)
+
+
+def _decode_legacy(blob):
+    df = read_csv(StringIO(bytes(blob).decode()))
+    # The first column is the index written by `DataFrame.to_csv`
+    return df.iloc[:, 1:]
+
+
+def decode_frame(blob):
+    """Decode a raw data table from its cached binary representation"""
+    if is_legacy(blob):
+        return _decode_legacy(blob)
+    df = _read_table(HEADER, blob).to_pandas()
+    # Arrow gives us None for missing text, but downstream
+    # code expects NaN as with CSV parsing
+    return df.fillna(N.nan)
+
+
+def encode_normalized(data, meta):
+    """
+    Encode a normalized data table and its column metadata. Column metadata
+    is small, so it is kept as JSON in the Arrow schema metadata.
+    """
+    tbl = Table.from_pandas(data, preserve_index=True)
+    meta_json = json.dumps(dict(
+        index=list(meta.index),
+        columns=list(meta.columns),
+        data=[[None if isnull(v) else v for v in row] for row in meta.values]))
+    schema_meta = dict(tbl.schema.metadata or {})
+    schema_meta[b"laserchron_meta"] = meta_json.encode()
+    return _write_table(NORMALIZED_HEADER, tbl.replace_schema_metadata(schema_meta))
+
+
+def decode_normalized(blob):
+    """Decode a cached `(data, meta)` pair"""
+    if bytes(blob[:len(NORMALIZED_MAGIC)]) != NORMALIZED_MAGIC:
+        raise ValueError("Not a cached normalized data table")
+    tbl = _read_table(NORMALIZED_HEADER, blob)
+    data = tbl.to_pandas().fillna(N.nan)
+
+    m = json.loads(tbl.schema.metadata[b"laserchron_meta"])
+    meta = DataFrame(m['data'], index=m['index'], columns=m['columns']).fillna(N.nan)
+    meta.columns.name = data.columns.name
+    return data, meta
+
+
+def deferred_tables(data_file):
+    """Query options to load cached tables only when they are accessed"""
+    return (defer(data_file.csv_data), defer(data_file.normalized_data))
+
+
+def iter_data_file_batches(db, query, batch_size=100):
+    """
+    Page through the `data_file` records of a query in lists of
+    `batch_size`, ordered by file hash, with cached tables deferred.
+
+    Batches are paged by file hash rather than streamed with `yield_per`,
+    since the importer commits after each file, which would close a
+    server-side cursor.
+    """
+    data_file = db.model.data_file
+    q = query.options(*deferred_tables(data_file)).order_by(data_file.file_hash)
+
+    last_hash = None
+    while True:
+        page = q
+        if last_hash is not None:
+            page = page.filter(data_file.file_hash > last_hash)
+        batch = page.limit(batch_size).all()
+        if len(batch) == 0:
+            break
+        last_hash = batch[-1].file_hash
+        yield batch
+
+
+def iter_data_files(db, query, batch_size=100):
+    """
+    Iterate over the `data_file` records of a query in batches. Cached
+    tables are loaded per record, when they are accessed, so at most one
+    batch of them is held in memory.
+    """
+    for batch in iter_data_file_batches(db, query, batch_size=batch_size):
+        yield from batch
+
+
+def migrate_legacy_rows(db, batch_size=100):
+    """
+    Rewrite `data_file` rows that hold CSV text in the binary cache format,
+    committing after each batch.
+    """
+    data_file = db.model.data_file
+    legacy = func.substring(data_file.csv_data, 1, len(MAGIC)) != MAGIC
+
+    q = (db.session.query(data_file.file_hash)
+            .filter(data_file.csv_data != None)
+            .filter(legacy)
+            .order_by(data_file.file_hash))
+
+    n_migrated = 0
+    last_hash = None
+    while True:
+        page = q
+        if last_hash is not None:
+            page = page.filter(data_file.file_hash > last_hash)
+        hashes = [h for h, in page.limit(batch_size)]
+        if len(hashes) == 0:
+            break
+        last_hash = hashes[-1]
+
+        recs = db.session.query(data_file).filter(data_file.file_hash.in_(hashes))
+        for rec in recs:
+            before = len(rec.csv_data)
+            try:
+                rec.csv_data = encode_frame(_decode_legacy(rec.csv_data))
+            except Exception as err:
+                secho(f"{rec.file_hash}: {err}", fg='red', dim=True)
+                continue
+            secho(f"{rec.basename}: {before} -> {len(rec.csv_data)} bytes", dim=True)
+            n_migrated += 1
+        db.session.commit()
+
+    return n_migrated
@@ -1,7 +1,8 @@
-from io import StringIO, BytesIO, IOBase
+from io import BytesIO
 from os import stat
-from pandas import read_excel
-from xlrd import open_workbook, XLRDError
+from hashlib import md5
+from functools import partial
+from tempfile import NamedTemporaryFile
 from click import secho
 from uuid import UUID
 from sqlalchemy.dialects.postgresql import insert
@@ -10,35 +11,92 @@ from datetime import datetime
 
 from sparrow.import_helpers import SparrowImportError, md5hash
 
-def get_excel_reader(infile):
-    try:
-        if isinstance(infile, IOBase):
-            # We have an in-memory file
-            fc = infile.read()
-            return open_workbook(file_contents=fc, on_demand=True)
-        else:
-            # We have a filename string
-            return open_workbook(infile, on_demand=True)
-    except Exception as err:
-        raise SparrowImportError(str(err))
-
-
-def encode_datatable(infile):
-    try:
-        wb = get_excel_reader(infile)
-        df = read_excel(wb, sheet_name="datatable", header=None)
-    except XLRDError:
-        if "AGE PICK" in infile.stem:
-            raise NotImplementedError("AGE PICK files are not yet handled")
-        raise SparrowImportError("No data table")
-    except AssertionError:
-        raise SparrowImportError("Could not open data table")
-
-    b = StringIO()
-    df.to_csv(b, compression='gzip')
-    b.seek(0)
-    # Convert to a binary representation
-    return b.read().encode()
+from .manifest import clean_etag
+from .datatable_cache import encode_frame
+from .workbooks import read_datatable, EXTRACTOR_VERSION
+from .failures import clear_failures
+from .profiling import NullProfile
+
+# Object bodies larger than this are spooled to a temporary file
+# instead of being held in memory
+SPOOL_MAX_MEMORY = 16*1024*1024
+SPOOL_CHUNK_SIZE = 64*1024
+
+
+class SpooledBody(object):
+    """
+    A file body that is hashed as it is read in chunks. It is kept in memory
+    until it grows past `max_memory`, and spooled to a temporary file after that.
+    """
+    def __init__(self, stream, stem=None,
+            max_memory=SPOOL_MAX_MEMORY, chunk_size=SPOOL_CHUNK_SIZE):
+        self.stem = stem
+        self.size = 0
+        self.name = None
+        self._buffer = BytesIO()
+        self._file = None
+
+        hash = md5()
+        try:
+            for chunk in iter(partial(stream.read, chunk_size), b""):
+                hash.update(chunk)
+                self.size += len(chunk)
+                if self._file is None and self.size > max_memory:
+                    self._rollover()
+                if self._file is None:
+                    self._buffer.write(chunk)
+                else:
+                    self._file.write(chunk)
+            if self._file is not None:
+                self._file.flush()
+        except BaseException:
+            # Don't leave a partial spool file behind
+            self.close()
+            raise
+        self.hash = hash.hexdigest()
+
+    def _rollover(self):
+        self._file = NamedTemporaryFile(prefix="laserchron-")
+        self._file.write(self._buffer.getbuffer())
+        self.name = self._file.name
+        self._buffer = None
+
+    def payload(self):
+        """
+        The contents if they are in memory, otherwise the spool file's path,
+        which workbook readers open themselves. Either can be sent to a
+        worker process cheaply.
+        """
+        if self._file is None:
+            # In CPython, this shares the buffer instead of copying it
+            return self._buffer.getvalue()
+        return self.name
+
+    def close(self):
+        """Release the contents, deleting the spool file if there is one"""
+        if self._file is not None:
+            # Temporary files are deleted when closed
+            self._file.close()
+            self._file = None
+        self._buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def encode_datatable(infile, stem=None):
+    if stem is None:
+        stem = getattr(infile, 'stem', "")
+    if isinstance(infile, SpooledBody):
+        # Read the spooled body in place rather than making another copy
+        infile = infile.payload()
+    df = read_datatable(infile, stem=stem)
+
+    # Convert to a compact binary representation
+    return encode_frame(df)
 
 
 def insert_on_conflict_update(db, model, **cols):
@@ -87,55 +145,96 @@ def import_datafile(db, infile):
         file_hash=hash,
         file_mtime=mtime,
         basename=infile.stem,
-        csv_data=None)
+        csv_data=None,
+        extract_error=None,
+        extractor_version=EXTRACTOR_VERSION)
 
     try:
         cols['csv_data'] = encode_datatable(infile)
-    except NotImplementedError as e:
+    except (SparrowImportError, NotImplementedError) as e:
         secho(str(e), fg='red', dim=True)
+        cols['extract_error'] = str(e)
 
     insert_on_conflict_update(db, data_file, **cols)
     return True
 
 
-def extract_s3_object(db, meta, content, redo=False):
-    # For some reason the ETag comes wrapped in quotes
-    etag = meta['ETag'].replace('"', "")
-    # S3 works in terms of 'keys' instead of filenames
-    key = meta["Key"]
+def extract_body(key, content):
+    """
+    Encode the data table of a downloaded object body. This does not touch
+    the database, so it can be run in a worker process. `content` can be a
+    `SpooledBody`, the body's bytes, or the path to a spooled copy.
 
-    secho(str(key), dim=True)
+    Returns a `(csv_data, error)` tuple.
+    """
+    try:
+        return encode_datatable(content, stem=Path(key).stem), None
+    except (SparrowImportError, NotImplementedError, IndexError, UnicodeDecodeError) as e:
+        return None, str(e)
 
-    fobj = BytesIO(content.read())
-    fobj.stem = Path(key).stem
-    # The md5 hash of a file is not always equivalent to its "ETag",
-    # but often is...
-    file_hash = md5hash(fobj)
 
-    data_file = db.model.data_file
+def needs_extraction(rec):
+    """Whether a data file failed to extract with an older extractor"""
+    return rec.csv_data is None and (rec.extractor_version or 0) < EXTRACTOR_VERSION
 
-    # Should maybe make sure error is not set
-    rec = db.get(data_file, file_hash)
-    # We are done if we've already imported
-    if rec is not None and not redo:
-        secho("Already extracted", fg='green', dim=True)
-        return rec, False
 
-    # Values to insert
+def insert_data_file(db, meta, file_hash, csv_data, error=None):
+    """
+    Insert or update the `data_file` record for an extracted object.
+    Extraction errors are recorded, so that failed files are not downloaded
+    again until the extractor changes.
+    """
+    etag = clean_etag(meta['ETag'])
+    # S3 works in terms of 'keys' instead of filenames
+    key = meta["Key"]
+
     cols = dict(
         file_path=key,
         file_hash=file_hash,
         file_etag=etag,
         file_mtime=meta['LastModified'],
-        basename=fobj.stem,
-        csv_data=None)
-
-    try:
-        cols['csv_data'] = encode_datatable(fobj)
-    except (SparrowImportError, NotImplementedError, IndexError, UnicodeDecodeError) as e:
-        secho(str(e), fg='red', dim=True)
-
-    insert_on_conflict_update(db, data_file, **cols)
+        basename=Path(key).stem,
+        csv_data=csv_data,
+        extract_error=error,
+        extractor_version=EXTRACTOR_VERSION,
+        # Invalidate normalized tables built from a previous extraction
+        normalized_data=None,
+        normalized_version=None)
+
+    insert_on_conflict_update(db, db.model.data_file, **cols)
+    # Give newly-extracted tables another chance to import
+    clear_failures(db, [file_hash])
     # Make sure we have updated values
     db.session.flush()
+
+
+def extract_s3_object(db, meta, content, redo=False, profile=NullProfile()):
+    key = meta["Key"]
+    secho(str(key), dim=True)
+
+    # Hash the body while reading it, so it is only held once.
+    # Reading the body is what downloads it.
+    with profile.stage("fetch", nbytes=meta.get('Size')):
+        body = SpooledBody(content, stem=Path(key).stem)
+    with body:
+        # The md5 hash of a file is not always equivalent to its "ETag",
+        # but often is...
+        file_hash = body.hash
+
+        data_file = db.model.data_file
+
+        # Should maybe make sure error is not set
+        rec = db.get(data_file, file_hash)
+        # We are done if we've already imported
+        if rec is not None and not redo and not needs_extraction(rec):
+            secho("Already extracted", fg='green', dim=True)
+            return rec, False
+
+        with profile.stage("parse", nbytes=body.size):
+            csv_data, error = extract_body(key, body)
+    if error is not None:
+        secho(error, fg='red', dim=True)
+
+    with profile.stage("write_data_file", nbytes=None if csv_data is None else len(csv_data)):
+        insert_data_file(db, meta, file_hash, csv_data, error=error)
     return rec, True
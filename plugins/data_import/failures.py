@@ -0,0 +1,57 @@
+"""
+Negative cache of data files that failed to import.
+
+A failure is recorded for each file hash with the error class, message and
+the importer version that raised it, as soon as the file fails. Later imports
+skip known failures, unless asked to retry them or the importer version has
+changed. Failures are cleared in the transaction that imports a file
+successfully, or when it is extracted again.
+"""
+from sqlalchemy import exists
+from sqlalchemy.dialects.postgresql import insert
+
+# Files that failed to import are skipped until this changes. Increment it
+# whenever a change to the importer might let those files import.
+IMPORTER_VERSION = 1
+
+
+def known_failure(db):
+    """Filter criterion for data files that failed with the current importer"""
+    data_file = db.model.data_file
+    Failure = db.model.data_file_failure
+    return (exists()
+        .where(Failure.file_hash == data_file.file_hash)
+        .where(Failure.importer_version == IMPORTER_VERSION))
+
+
+def skip_known_failures(db, query):
+    return query.filter(~known_failure(db))
+
+
+def known_failure_hashes(db):
+    """File hashes that failed with the current importer, in one query"""
+    Failure = db.model.data_file_failure
+    q = (db.session.query(Failure.file_hash)
+            .filter(Failure.importer_version == IMPORTER_VERSION))
+    return {str(h) for h, in q}
+
+
+def clear_failures(db, file_hashes):
+    if len(file_hashes) == 0:
+        return
+    tbl = db.model.data_file_failure.__table__
+    db.session.execute(tbl.delete().where(tbl.c.file_hash.in_(list(file_hashes))))
+
+
+def record_failure(db, file_hash, error_class, message):
+    """Record the failure of a data file, replacing any earlier one"""
+    tbl = db.model.data_file_failure.__table__
+    q = insert(tbl).values(
+        file_hash=file_hash,
+        error_class=error_class,
+        message=message,
+        importer_version=IMPORTER_VERSION)
+    q = q.on_conflict_do_update(
+        index_elements=[tbl.c.file_hash],
+        set_={k: q.excluded[k] for k in ('error_class', 'message', 'importer_version', 'failed')})
+    db.session.execute(q)
@@ -0,0 +1,30 @@
+"""
+Maintenance of the precomputed summaries in the `lab_view` schema.
+"""
+from click import secho
+from sqlalchemy import text
+
+materialized_views = [
+    "lab_view.aggregate_histogram",
+]
+
+
+def refresh_lab_views(db):
+    """
+    Refresh materialized views over imported data. Views are refreshed
+    concurrently, so the site can keep reading them in the meantime.
+    """
+    for view in materialized_views:
+        db.session.execute(text(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {view}"))
+        db.session.commit()
+        secho(f"Refreshed {view}", dim=True)
+
+
+def update_age_buckets(db, session_id):
+    """
+    Recompute the precomputed age histogram buckets for a session
+    from its accepted datums, within the current transaction.
+    """
+    db.session.execute(
+        text("SELECT lab_view.refresh_age_buckets(:session_id)"),
+        dict(session_id=session_id))
@@ -1,53 +1,127 @@
 from sparrow.import_helpers import SparrowImportError, BaseImporter
 from datetime import datetime
-from io import StringIO
-from pandas import read_csv, isnull
+from functools import lru_cache
+from pandas import isnull, to_numeric, DataFrame
 import numpy as N
-from sqlalchemy.exc import IntegrityError, ProgrammingError, DataError
+from sqlalchemy import select, text
+from sqlalchemy.dialects.postgresql import insert
+from pyarrow import ArrowException
+from sqlalchemy.exc import IntegrityError, ProgrammingError, DataError, OperationalError
 from click import echo, style
 from datefinder import find_dates
 import re
 
-from .normalize_data import normalize_data
+from .normalize_data import normalize_data, NORMALIZER_VERSION
+from .datatable_cache import decode_frame, encode_normalized, decode_normalized
 from .sample_names import generalize_samples
+from .lookup_cache import LookupCache
+from .lab_views import update_age_buckets
+from .profiling import NullProfile
+from .failures import IMPORTER_VERSION, record_failure, clear_failures
 
-def __extract_datetime(possible_date_string):
+# PostgreSQL error code for a detected deadlock
+DEADLOCK_DETECTED = "40P01"
+
+def _find_datetime(possible_date_string):
     dates = find_dates(possible_date_string, source=True, base_date=datetime.min)
     for date, source_text in dates:
         if len(source_text) < 5:
             continue
-        echo("Extracted date "
-             + style(str(date), fg='green')
-             + " from " + style(source_text, fg='green'))
-        return date
+        return date, source_text
+
+    return None
 
+_months = {m: i+1 for i, m in enumerate([
+    "jan", "feb", "mar", "apr", "may", "jun",
+    "jul", "aug", "sep", "oct", "nov", "dec"])}
+_month = (r"(?P<month>jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?"
+          r"|aug(?:ust)?|sep(?:t(?:ember)?)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)")
+_day = r"(?P<day>\d{1,2})"
+_year = r"(?P<year>\d{4})"
+
+# Folder date layouts that we can parse without datefinder. These only match
+# whole path segments, for which datefinder gives the same result.
+_date_layouts = [re.compile(p, flags=re.IGNORECASE) for p in (
+    r"(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})",
+    _day+r"\s+"+_month+r"\s+"+_year,
+    _month+r"\s+"+_day+r",?\s+"+_year,
+    _month+r"\s+"+_year,
+)]
+
+def _parse_date_layout(pathseg):
+    for pattern in _date_layouts:
+        m = pattern.fullmatch(pathseg.strip())
+        if m is None:
+            continue
+        parts = m.groupdict()
+        month = parts['month']
+        if not month.isdigit():
+            month = _months.get(month[:3].lower())
+        try:
+            return datetime(int(parts['year']), int(month), int(parts.get('day') or 1))
+        except (ValueError, TypeError):
+            return None
     return None
 
 range_regex = re.compile(r"(\d+)-(\d+)\s")
+
+@lru_cache(maxsize=4096)
+def segment_datetime(pathseg):
+    """Date found in a single path segment. The same folder names recur
+       across many files, so results are cached."""
+    without_ranges = range_regex.sub(r"\2 ", pathseg)
+    for seg in (without_ranges, pathseg):
+        dt = _parse_date_layout(seg)
+        if dt is not None:
+            return dt
+        res = _find_datetime(seg)
+        if res is not None:
+            date, source_text = res
+            echo("Extracted date "
+                 + style(str(date), fg='green')
+                 + " from " + style(source_text, fg='green'))
+            return date
+    return None
+
 def extract_datetime(st):
     for pathseg in st.split("/")[::-1]:
-        without_ranges = range_regex.sub(r"\2 ", pathseg)
-        dt = __extract_datetime(without_ranges)
-        if dt is None:
-            dt = __extract_datetime(pathseg)
+        dt = segment_datetime(pathseg)
         if dt is not None:
             return dt
     return None
 
 def decode_datatable(csv_data):
-    """Extract a CSV data table from its binary representation
+    """Extract a data table from its binary representation
        in the PostgreSQL database."""
-    tbl = csv_data
-    if tbl is None:
+    if csv_data is None:
+        return
+    return normalize_data(decode_frame(csv_data))
+
+def load_datatable(rec):
+    """Normalized data table and column metadata for a `data_file` record.
+       These are cached on the record, and only rebuilt when the normalizer
+       version changes."""
+    cached = rec.normalized_data
+    if cached is not None and rec.normalized_version == NORMALIZER_VERSION:
+        return decode_normalized(cached)
+    res = decode_datatable(rec.csv_data)
+    if res is None:
         return
-    f = StringIO()
-    f.write(tbl.decode())
-    f.seek(0)
-    df = read_csv(f)
-    df = df.iloc[:,1:]
-    return normalize_data(df)
+    try:
+        rec.normalized_data = encode_normalized(*res)
+        rec.normalized_version = NORMALIZER_VERSION
+    except (ArrowException, ValueError, TypeError) as err:
+        # Arrow can't store some tables, e.g. with duplicate column names
+        # or mixed-type columns. These are just normalized on every import.
+        echo(style(f"Not caching normalized table: {err}", dim=True))
+    return res
 
 
+def error_class(err):
+    """Name of the error behind a `SparrowImportError`"""
+    cause = err.__cause__ or err.__context__ or err
+    return type(cause).__name__
+
 def infer_project_name(fp):
     folders = fp.split("/")[:-1]
     return max(folders, key=len)
@@ -57,6 +131,64 @@ def nan_to_none(val):
         return None
     return val
 
+def _to_float(series):
+    """Convert a column to floats, with unparseable values set to NaN"""
+    try:
+        return series.astype(float)
+    except (ValueError, TypeError):
+        return to_numeric(series, errors='coerce')
+
+def _is_value_column(key):
+    # Errors are attached to their values, and we test for best ages
+    # separately, since they must be one of the other ages
+    return not (key == 'analysis' or key.endswith("_error") or key == 'best_age')
+
+def long_datums(df, meta):
+    """
+    Melt a sample's data table into one row per datum, with columns for the
+    analysis row position, parameter, value, error, units, and best-age flag.
+    Non-numeric and missing values are dropped.
+    """
+    value_cols = [c for c in df.columns if _is_value_column(c)]
+    n = len(df)
+
+    values = DataFrame({c: _to_float(df[c]).values for c in value_cols},
+                       index=range(n), columns=value_cols)
+    errors = DataFrame(index=range(n), columns=value_cols, dtype=float)
+    for c in value_cols:
+        err_ix = c+"_error"
+        if err_ix in df.columns:
+            errors[c] = _to_float(df[err_ix]).values
+
+    stacked = values.stack()
+    if stacked.empty:
+        return DataFrame(columns=['row', 'parameter', 'value', 'error',
+            'unit', 'error_unit', 'is_age', 'is_accepted'])
+    rows = stacked.index.get_level_values(0)
+    params = stacked.index.get_level_values(1)
+
+    units = meta.loc['Unit']
+    long = DataFrame({
+        'row': rows,
+        'parameter': params,
+        'value': stacked.values,
+        'error': errors.stack(dropna=False).reindex(stacked.index).values,
+        'unit': params.map(units.to_dict()),
+        'error_unit': [units.get(p+"_error") if p+"_error" in units.index else None
+                       for p in params],
+        'is_age': params.str.startswith("age_"),
+    })
+
+    long['is_accepted'] = False
+    if long['is_age'].any():
+        # Ages must parse as numbers to be tested as best ages
+        best_age = df['best_age'].astype(float).values
+        age = long['is_age'].values
+        long.loc[age, 'is_accepted'] = N.isclose(
+            long.loc[age, 'value'].values,
+            best_age[long.loc[age, 'row'].values])
+    return long
+
 def _sample_dataframe(df, sample_name):
     names = df.index.get_level_values('sample_name')
     ix = names == sample_name
@@ -72,6 +204,100 @@ class LaserchronImporter(BaseImporter):
     """
     authority = "ALC"
     trust_file_times = False
+    # Write analyses and datums with multi-row INSERT statements
+    # rather than through the ORM
+    bulk_insert = True
+    bulk_batch_size = 1000
+    # Per-stage timing, replaced by an `ImportProfile` when profiling
+    profile = NullProfile()
+    # Record failed files in the negative cache (see failures.py), which
+    # commits each failure. Turned off when the caller owns the transaction.
+    cache_failures = True
+    # Set by `import_parallel`, whose workers can conflict with each other.
+    # Files that hit a conflict are retried serially rather than recorded
+    # as failures.
+    retry_conflicts = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.errors = []
+        self.conflicts = []
+        self.lookups = LookupCache()
+        self.lookups.bind(self.db.session)
+        self.prewarm_lookups()
+
+    def close(self):
+        """Stop tracking the database session's transactions for the lookup cache"""
+        self.lookups.unbind()
+
+    def prewarm_lookups(self):
+        """Load the (small) unit and datum type vocabularies up front"""
+        for unit in self.db.session.query(self.m.vocabulary_unit):
+            self.lookups.put('unit', unit.id, unit)
+        DatumType = self.m.datum_type
+        for dt in self.db.session.query(DatumType).order_by(DatumType.id.desc()):
+            # Keyed as in `datum_type`, for the arguments that `bulk_import_datums`
+            # passes. The lowest id is kept, as `get_or_create` would find it first.
+            key = (dt.parameter,
+                ('error_metric', dt.error_metric),
+                ('error_unit', dt.error_unit),
+                ('is_interpreted', dt.is_interpreted),
+                ('unit', dt.unit))
+            self.lookups.put('datum_type', key, dt)
+
+    def unit(self, id):
+        create = super().unit
+        return self.lookups.get('unit', id, lambda: create(id))
+
+    def datum_type(self, parameter, **kwargs):
+        create = super().datum_type
+        key = (parameter, *sorted(kwargs.items()))
+        return self.lookups.get('datum_type', key, lambda: create(parameter, **kwargs))
+
+    def _flushed_id(self, model):
+        self.db.session.add(model)
+        self.db.session.flush()
+        return model.id
+
+    def _lock(self, kind, name):
+        """
+        Serialize get-or-create of a named model across concurrent imports,
+        until the end of the transaction. Names are not unique in the
+        database, so concurrent creation would silently duplicate them.
+        """
+        self.db.session.execute(
+            text("SELECT pg_advisory_xact_lock(hashtext(:key))"),
+            dict(key=f"{kind}:{name}"))
+
+    def lock_names(self, project_name, sample_names):
+        """
+        Take the creation locks for all of a file's uncached project and
+        sample names at once, ordered by lock key. Taking them as they come
+        up would let two imports that share names in a different order
+        deadlock each other.
+        """
+        keys = [f"{kind}:{name}" for kind, names in (('project', [project_name]), ('sample', sample_names))
+                for name in names
+                if name is not None and not self.lookups.has(kind, name)]
+        if len(keys) == 0:
+            return
+        self.db.session.execute(text(
+            """SELECT pg_advisory_xact_lock(k) FROM (
+                SELECT DISTINCT hashtext(key) AS k FROM unnest(CAST(:keys AS text[])) AS key
+                ORDER BY k) AS ordered"""),
+            dict(keys=keys))
+
+    def _locked_id(self, kind, name, create):
+        def locked_create():
+            self._lock(kind, name)
+            return self._flushed_id(create())
+        return self.lookups.get(kind, name, locked_create)
+
+    def project_id(self, name):
+        return self._locked_id('project', name, lambda: self.project(name))
+
+    def sample_id(self, name):
+        return self._locked_id('sample', name, lambda: self.sample(name=name))
 
     def import_all(self, redo=False):
         self.redo = redo
@@ -87,30 +313,76 @@ class LaserchronImporter(BaseImporter):
         """
         data file -> sample(s)
         """
+        try:
+            with self.profile.file(rec.file_path or rec.basename):
+                yield from self._import_datafile(rec)
+        except SparrowImportError as err:
+            # Collected so that errors can be summarized across workers
+            self.errors.append((rec.file_hash, str(err)))
+            if self.cache_failures and rec.file_hash not in self.conflicts:
+                self.record_failure(rec.file_hash, err)
+            raise
+        if self.cache_failures:
+            # In the same transaction as the import, which is committed
+            # once this generator is exhausted
+            clear_failures(self.db, [rec.file_hash])
+
+    def record_failure(self, file_hash, err):
+        """
+        Record a failed file in the negative cache (see failures.py). The
+        file's partial import is rolled back first, so the failure is
+        committed on its own, before the next file is imported.
+        """
+        self.db.session.rollback()
+        record_failure(self.db, file_hash, error_class(err), str(err))
+        self.db.session.commit()
+
+    def _import_datafile(self, rec):
         if "NUPM-MON" in rec.basename:
             raise SparrowImportError("NUPM-MON files are not handled yet")
         if not rec.csv_data:
-            raise SparrowImportError("CSV data not extracted")
+            raise SparrowImportError(rec.extract_error or "CSV data not extracted")
 
         try:
-            data, meta = decode_datatable(rec.csv_data)
+            with self.profile.stage("normalize_data", nbytes=len(rec.csv_data)) as stage:
+                data, meta = load_datatable(rec)
+                stage['rows'] = len(data)
             self.meta = meta
             data.index.name = 'analysis'
         except IndexError as err:
             raise SparrowImportError(err)
 
-        data = generalize_samples(data)
+        with self.profile.stage("generalize_samples", rows=len(data)):
+            data = generalize_samples(data)
 
         sample_names = list(data.index.unique(level=0))
 
         if self.verbose:
             echo("Samples: "+", ".join(sample_names))
 
+        self.lock_names(infer_project_name(rec.file_path),
+                        [nan_to_none(name) for name in sample_names])
+
         for sample_name in sample_names:
             df = _sample_dataframe(data, sample_name)
             try:
                 yield self.import_session(rec, df)
-            except (IntegrityError, ProgrammingError, DataError) as err:
+            except IntegrityError as err:
+                # In a parallel import, most likely another worker created the
+                # same project or sample concurrently, so this file can be
+                # retried. Otherwise this is a real constraint violation.
+                if self.retry_conflicts:
+                    self.conflicts.append(rec.file_hash)
+                raise SparrowImportError(str(err.orig))
+            except OperationalError as err:
+                if getattr(err.orig, 'pgcode', None) != DEADLOCK_DETECTED:
+                    raise
+                # Shouldn't happen with names locked up front, but is
+                # resolved the same way, by retrying the file
+                if self.retry_conflicts:
+                    self.conflicts.append(rec.file_hash)
+                raise SparrowImportError(str(err.orig))
+            except (ProgrammingError, DataError) as err:
                 raise SparrowImportError(str(err.orig))
             # Handle common error types
             except (IndexError, ValueError, AssertionError, TypeError) as err:
@@ -120,9 +392,10 @@ class LaserchronImporter(BaseImporter):
 
         # Infer project name
         project_name = infer_project_name(rec.file_path)
-        project = self.project(project_name)
+        project_id = self.project_id(project_name)
 
-        date = extract_datetime(rec.file_path)
+        with self.profile.stage("extract_datetime"):
+            date = extract_datetime(rec.file_path)
 
         if self.trust_file_times:
             date = rec.file_mtime
@@ -133,17 +406,16 @@ class LaserchronImporter(BaseImporter):
         sample_name = nan_to_none(df.index.unique(level='sample_name')[0])
         sample_id = None
         if sample_name is not None:
-            sample = self.sample(name=sample_name)
-            self.db.session.add(sample)
-            sample_id = sample.id
-
-        self.db.session.add(project)
+            sample_id = self.sample_id(sample_name)
 
-        # See if a matching session exists, otherwise create.
-        # Not sure if this will work right now
-        session = (self.db.session.query(self.m.session)
-                    .filter(self.m.data_file == rec)
-                    .first())
+        # See if this file already has a session for the sample, otherwise create.
+        Session, Link = self.m.session, self.m.data_file_link
+        with self.profile.stage("find_session"):
+            session = (self.db.session.query(Session)
+                        .join(Link, Link.session_id == Session.id)
+                        .filter(Link.file_hash == rec.file_hash)
+                        .filter(Session.sample_id == sample_id)
+                        .first())
 
         if session is not None:
             self.warn(f"Existing session {session.id} found")
@@ -153,19 +425,20 @@ class LaserchronImporter(BaseImporter):
             # We need to create new sample and project models only if they aren't tied
             # to an existing session, or ask the user whether they want to override
             # Sparrow-configured values by those set within the linked data file.
-            session.project_id = project.id
+            session.project_id = project_id
             session.sample_id = sample_id
         else:
             session = self.db.get_or_create(
                 self.m.session,
-                project_id=project.id,
+                project_id=project_id,
                 sample_id=sample_id)
 
         # We always override the date with our estimated value
         session.date = date
 
-        self.db.session.add(session)
-        self.db.session.flush()
+        with self.profile.stage("flush"):
+            self.db.session.add(session)
+            self.db.session.flush()
 
         dup = df['analysis'].duplicated(keep='first')
         if dup.astype(bool).sum() > 0:
@@ -173,84 +446,158 @@ class LaserchronImporter(BaseImporter):
             self.warn(f"Duplicate analyses found for sample {sample_name}")
         df = df[~dup]
 
-        for i, row in df.iterrows():
-            list(self.import_analysis(row, session))
+        try:
+            with self.profile.stage("long_datums", rows=len(df)):
+                datums = long_datums(df, self.meta)
+        except ValueError as err:
+            raise SparrowImportError(err)
+
+        with self.profile.stage("insert_datums", rows=len(datums)):
+            if self.bulk_insert:
+                analysis_ids = self.bulk_import_analyses(df, session)
+                self.bulk_import_datums(analysis_ids, datums)
+            else:
+                # Create analyses in table order, then datums
+                analyses = [self.import_analysis(ix, session) for ix in df.index]
+                list(self.import_datums(analyses, datums))
+
+        with self.profile.stage("flush"):
+            self.db.session.flush()
+        with self.profile.stage("update_age_buckets"):
+            update_age_buckets(self.db, session.id)
 
         return session
 
-    def import_analysis(self, row, session):
+    def import_analysis(self, index, session):
         """
-        row -> analysis
+        (sample_name, analysis_name, session_index) -> analysis
         """
         # session index should not be nan
         try:
-            ix = int(row.name[2])
+            ix = int(index[2])
         except ValueError:
             ix = None
 
-        analysis = self.add_analysis(
+        return self.add_analysis(
             session,
             session_index=ix,
-            analysis_name=str(row.name[1]))
+            analysis_name=str(index[1]))
 
-        for i in row.iteritems():
+    def import_datums(self, analyses, datums):
+        """
+        Long-form datum table -> datums
+        """
+        unit_id = self._unit_ids()
+
+        for d in datums.itertuples(index=False):
+            error = None
+            if not isnull(d.error):
+                error = float(d.error)
+            error_unit = unit_id(d.error_unit)
+
+            datum = self.datum(analyses[d.row], d.parameter, float(d.value),
+                unit=unit_id(d.unit),
+                error=error,
+                error_unit=error_unit,
+                error_metric="2s",
+                is_interpreted=bool(d.is_age))
+
+            if d.is_age:
+                datum.is_accepted = bool(d.is_accepted)
+            yield datum
+
+    def _unit_ids(self):
+        # Resolve each unit once rather than once per value
+        unit_ids = {}
+        def unit_id(u):
+            if isnull(u):
+                return None
+            if u not in unit_ids:
+                unit_ids[u] = self.unit(u).id
+            return unit_ids[u]
+        return unit_id
+
+    def bulk_import_analyses(self, df, session):
+        """
+        Get or create the analyses for a session with one query and one
+        multi-row insert. Returns analysis ids in table order.
+        """
+        tbl = self.m.analysis.__table__
+        keys = []
+        for index in df.index:
             try:
-                d = self.import_datum(analysis, *i, row)
-            except (ValueError, AttributeError) as err:
-                # Correct thing to do: raise SparrowImportError.
-                # This tells the application that you explicitly handled
-                # this error, and to report it without stopping.
-                raise SparrowImportError(err)
-            if d is None:
-                continue
-            yield d
-
-    def import_datum(self, analysis, key, value, row):
+                ix = int(index[2])
+            except ValueError:
+                ix = None
+            keys.append((ix, str(index[1])))
+
+        q = (select([tbl.c.id, tbl.c.session_index, tbl.c.analysis_name])
+                .where(tbl.c.session_id == session.id))
+        ids = {(r.session_index, r.analysis_name): r.id
+               for r in self.db.session.execute(q)}
+
+        # Keep the first occurrence of each new key, in table order
+        missing = list(dict.fromkeys(key for key in keys if key not in ids))
+
+        if len(missing) > 0:
+            rows = [dict(session_id=session.id, session_index=ix, analysis_name=name)
+                    for ix, name in missing]
+            q = (insert(tbl).values(rows)
+                    .returning(tbl.c.id, tbl.c.session_index, tbl.c.analysis_name))
+            for r in self.db.session.execute(q):
+                ids[(r.session_index, r.analysis_name)] = r.id
+
+        return [ids[key] for key in keys]
+
+    def bulk_import_datums(self, analysis_ids, datums):
         """
-        Each value in a table row -> datum
+        Write datums with multi-row upserts, after resolving each distinct
+        datum type once. Produces the same rows as `import_datums`.
         """
-        if key == 'analysis':
-            return None
-        if key.endswith("_error"):
-            return None
-        if key == 'best_age':
-            # We test for best ages separately, since they
-            # must be one of the other ages
-            return None
-
-        try:
-            value = float(value)
-        except ValueError:
-            return None
-        if isnull(value):
-            return None
-
-        m = self.meta[key]
-        parameter = m.name
-
-        unit = self.unit(m.at['Unit']).id
+        tbl = self.m.datum.__table__
+        unit_id = self._unit_ids()
+
+        # Resolve each distinct datum type once, and flush so that
+        # newly-created types have ids
+        types = {}
+        for d in datums.itertuples(index=False):
+            key = (d.parameter, unit_id(d.unit), unit_id(d.error_unit), bool(d.is_age))
+            if key in types:
+                continue
+            parameter, unit, error_unit, is_age = key
+            types[key] = self.datum_type(parameter,
+                unit=unit,
+                error_unit=error_unit,
+                error_metric="2s",
+                is_interpreted=is_age)
+        self.db.session.flush()
 
-        err = None
-        err_unit = None
-        try:
-            err_ix = key+"_error"
-            err = row.at[err_ix]
-            i = self.meta[err_ix].at['Unit']
-            err_unit = self.unit(i).id
-        except KeyError:
-            pass
-
-        is_age = key.startswith("age_")
-
-        datum = self.datum(analysis, parameter, value,
-            unit=unit,
-            error=err,
-            error_unit=err_unit,
-            error_metric="2s",
-            is_interpreted=is_age)
-
-        if is_age:
-            # Test if it is a "best age"
-            best_age = float(row.at['best_age'])
-            datum.is_accepted = N.allclose(value, best_age)
-        return datum
+        def type_id(d):
+            key = (d.parameter, unit_id(d.unit), unit_id(d.error_unit), bool(d.is_age))
+            return types[key].id
+
+        # Only ages are tested for acceptance, so rows for other
+        # parameters leave `is_accepted` alone. Rows are keyed by
+        # (analysis, type), since an upsert can't touch the same row twice;
+        # the last value wins, as it did when datums were written one by one.
+        ages, others = {}, {}
+        for d in datums.itertuples(index=False):
+            row = dict(
+                analysis=analysis_ids[d.row],
+                type=type_id(d),
+                value=float(d.value),
+                error=None if isnull(d.error) else float(d.error))
+            target = others
+            if d.is_age:
+                row['is_accepted'] = bool(d.is_accepted)
+                target = ages
+            target[(row['analysis'], row['type'])] = row
+
+        for rows in (list(ages.values()), list(others.values())):
+            for i in range(0, len(rows), self.bulk_batch_size):
+                q = insert(tbl).values(rows[i:i+self.bulk_batch_size])
+                update = {k: q.excluded[k] for k in rows[0] if k not in ('analysis', 'type')}
+                q = q.on_conflict_do_update(
+                    index_elements=[tbl.c.analysis, tbl.c.type],
+                    set_=update)
+                self.db.session.execute(q)
@@ -0,0 +1,71 @@
+"""
+In-process memoization of get-or-create lookups during an import.
+
+The set of distinct units, datum types, projects and samples touched by an
+import is small compared to the number of values imported, so we keep them
+around for the lifetime of the importer. Anything created in a transaction
+that is rolled back is no longer valid, so those entries are dropped on
+rollback. Entries that were prewarmed or created in committed transactions
+are kept.
+"""
+from collections import Counter
+from click import echo, style
+from sqlalchemy import event
+
+
+class LookupCache(object):
+    def __init__(self):
+        self.values = {}
+        # (kind, key) of entries created since the last commit
+        self.created = set()
+        self.hits = Counter()
+        self.misses = Counter()
+        self.session = None
+
+    def get(self, kind, key, create):
+        """Get a cached value, calling `create` to build it on a miss"""
+        cache = self.values.setdefault(kind, {})
+        if key in cache:
+            self.hits[kind] += 1
+            return cache[key]
+        self.misses[kind] += 1
+        value = create()
+        cache[key] = value
+        self.created.add((kind, key))
+        return value
+
+    def has(self, kind, key):
+        return key in self.values.get(kind, {})
+
+    def put(self, kind, key, value):
+        self.values.setdefault(kind, {})[key] = value
+
+    def clear(self):
+        self.values.clear()
+        self.created.clear()
+
+    def _committed(self, session):
+        self.created.clear()
+
+    def _rolled_back(self, session, previous_transaction):
+        for kind, key in self.created:
+            self.values[kind].pop(key, None)
+        self.created.clear()
+
+    def bind(self, session):
+        """Track commits and rollbacks of `session`, until `unbind` is called"""
+        self.session = session
+        event.listen(session, "after_commit", self._committed)
+        event.listen(session, "after_soft_rollback", self._rolled_back)
+
+    def unbind(self):
+        if self.session is None:
+            return
+        event.remove(self.session, "after_commit", self._committed)
+        event.remove(self.session, "after_soft_rollback", self._rolled_back)
+        self.session = None
+
+    def report(self):
+        echo(style("Lookup cache", bold=True), err=True)
+        for kind in sorted(set(self.hits) | set(self.misses)):
+            echo(f"- {kind}: {self.hits[kind]} hits, {self.misses[kind]} misses", err=True)
@@ -0,0 +1,118 @@
+"""
+Check cloud object listings against the `data_file` table so that objects
+which have not changed since they were last extracted are never downloaded.
+"""
+from itertools import islice
+from datetime import timezone
+from uuid import UUID
+from sqlalchemy import func
+from .datatable_cache import deferred_tables
+from .workbooks import EXTRACTOR_VERSION
+
+
+def clean_etag(etag):
+    # For some reason the ETag comes wrapped in quotes
+    return etag.replace('"', "")
+
+
+def is_md5_etag(etag):
+    """
+    Single-part uploads have an ETag equal to the MD5 hash of the object body.
+    Multipart uploads have an ETag of the form `<hash>-<number of parts>`.
+    """
+    return len(etag) == 32 and "-" not in etag
+
+
+def _batches(iterable, size):
+    it = iter(iterable)
+    while True:
+        batch = list(islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+
+def hash_key(value):
+    """
+    A file hash as a UUID, whether it is given as a bare hex digest (like an
+    ETag), a dashed string, or a UUID as loaded from the `file_hash` column.
+    """
+    try:
+        return UUID(str(value))
+    except ValueError:
+        return None
+
+
+def _utc(dt):
+    # Timestamps from the database are naive UTC, while object
+    # listings give timezone-aware datetimes
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+
+def _is_unchanged(meta, rec):
+    etag = clean_etag(meta['ETag'])
+    if rec.file_etag is not None:
+        return rec.file_etag == etag
+    # Records extracted before ETags were tracked
+    if rec.file_mtime is None:
+        return False
+    return _utc(rec.file_mtime) == _utc(meta['LastModified'])
+
+
+def match_batch(batch, by_path, by_hash):
+    """
+    Yield `(meta, rec)` pairs for a batch of listed objects, given existing
+    records keyed by file path and by `hash_key` of their file hash.
+    """
+    for meta in batch:
+        rec = by_path.get(meta['Key'])
+        if rec is not None and _is_unchanged(meta, rec):
+            yield meta, rec
+            continue
+        etag = clean_etag(meta['ETag'])
+        if is_md5_etag(etag):
+            yield meta, by_hash.get(hash_key(etag))
+        else:
+            yield meta, None
+
+
+def check_manifest(db, objects, batch_size=500):
+    """
+    Match an object listing against existing `data_file` records in batches.
+
+    Yields `(meta, rec)` pairs, where `rec` is the existing record if the object
+    is unchanged since it was last extracted, and `None` if it needs to be
+    downloaded. Objects that failed to extract with an older extractor
+    are downloaded again.
+    """
+    data_file = db.model.data_file
+    # Checked in the database, so that cached tables stay unloaded
+    stale = (data_file.csv_data == None) & (
+        func.coalesce(data_file.extractor_version, 0) < EXTRACTOR_VERSION)
+
+    for batch in _batches(objects, batch_size):
+        keys = [meta['Key'] for meta in batch]
+        by_path = {}
+        q = (db.session.query(data_file)
+                .options(*deferred_tables(data_file))
+                .filter(data_file.file_path.in_(keys))
+                .filter(~stale))
+        for rec in q:
+            by_path[rec.file_path] = rec
+
+        # Single-part ETags are trusted MD5 hashes, so we can also recognize
+        # objects that were moved or copied within the bucket.
+        hashes = [clean_etag(meta['ETag']) for meta in batch]
+        hashes = [str(hash_key(h)) for h in hashes if is_md5_etag(h)]
+        by_hash = {}
+        if len(hashes) > 0:
+            q = (db.session.query(data_file)
+                    .options(*deferred_tables(data_file))
+                    .filter(data_file.file_hash.in_(hashes))
+                    .filter(~stale))
+            for rec in q:
+                by_hash[hash_key(rec.file_hash)] = rec
+
+        yield from match_batch(batch, by_path, by_hash)
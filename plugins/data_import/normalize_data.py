@@ -5,6 +5,10 @@ import re
 
 from sparrow.import_helpers import SparrowImportError
 
+# Normalized tables are cached in the database alongside the raw data table.
+# Increment this whenever a change to this module alters its output, so that
+# cached tables are rebuilt on the next import.
+NORMALIZER_VERSION = 1
 
 def merge_cols(d):
     v1 = d.iloc[0]
@@ -0,0 +1,124 @@
+"""
+Import data files on a pool of worker processes, each with its own
+database connections.
+
+The coordinator splits tracked data files into slices by project, so that
+workers do not race to create the same project. Samples can be shared
+between projects, so the importer serializes their creation with advisory
+locks. Files that still hit a conflict are retried serially once the pool
+has finished, and errors are summarized centrally.
+"""
+from multiprocessing import get_context
+from collections import defaultdict
+from click import echo, secho, style
+
+from .laserchron_importer import LaserchronImporter, infer_project_name
+from .datatable_cache import iter_data_files
+from .profiling import ImportProfile, NullProfile
+
+# The application is inherited by forked workers rather than pickled
+_app = None
+
+
+def _init_worker():
+    """
+    Replace the connection pool inherited from the coordinator, so that
+    connections are never shared across processes. With `close=False`,
+    the coordinator's connections are left alone rather than closed from
+    the worker, as recommended by SQLAlchemy for forked processes.
+    """
+    _app.database.engine.dispose(close=False)
+
+
+def _import_slice(args):
+    file_hashes, redo, bulk, profile = args
+    db = _app.database
+    data_file = db.model.data_file
+
+    importer = LaserchronImporter(_app)
+    importer.bulk_insert = bulk
+    importer.retry_conflicts = True
+    if profile:
+        # Stage records are sent back to the coordinator; cProfile
+        # dumps are only made for serial imports.
+        importer.profile = ImportProfile()
+
+    q = db.session.query(data_file).filter(data_file.file_hash.in_(file_hashes))
+    try:
+        importer.iter_records(iter_data_files(db, q), redo=redo)
+    finally:
+        importer.close()
+    db.session.close()
+
+    return dict(
+        n_files=len(file_hashes),
+        errors=importer.errors,
+        conflicts=importer.conflicts,
+        profile=getattr(importer.profile, 'records', []))
+
+
+def partition_by_project(rows, n_slices):
+    """
+    Split `(file_hash, file_path)` rows into `n_slices` lists of file hashes,
+    keeping each project in a single slice and balancing slice sizes.
+    """
+    projects = defaultdict(list)
+    for file_hash, file_path in rows:
+        project = None
+        if file_path is not None:
+            project = infer_project_name(file_path)
+        projects[project].append(file_hash)
+
+    slices = [[] for i in range(n_slices)]
+    # Largest projects first, each to the currently smallest slice
+    for hashes in sorted(projects.values(), key=len, reverse=True):
+        min(slices, key=len).extend(hashes)
+    return [s for s in slices if len(s) > 0]
+
+
+def import_parallel(app, query, workers=2, redo=False, bulk=True, profile=NullProfile()):
+    global _app
+    db = app.database
+    data_file = db.model.data_file
+
+    rows = query.with_entities(data_file.file_hash, data_file.file_path).all()
+    slices = partition_by_project(rows, workers)
+    # Don't carry an open transaction into the workers
+    db.session.commit()
+    if len(slices) == 0:
+        # No files to import, e.g. when all of them are known failures
+        echo(style("Imported ", bold=True)+"0 files")
+        return []
+
+    _app = app
+    ctx = get_context("fork")
+    with ctx.Pool(len(slices), initializer=_init_worker) as pool:
+        results = pool.map(_import_slice, [(s, redo, bulk, profile.enabled) for s in slices])
+
+    errors = []
+    conflicts = []
+    for res in results:
+        errors += res['errors']
+        conflicts += res['conflicts']
+        profile.extend(res['profile'])
+
+    if len(conflicts) > 0:
+        secho(f"Retrying {len(conflicts)} files with conflicts", fg='yellow')
+        importer = LaserchronImporter(app)
+        importer.bulk_insert = bulk
+        importer.profile = profile
+        q = db.session.query(data_file).filter(data_file.file_hash.in_(conflicts))
+        try:
+            importer.iter_records(iter_data_files(db, q), redo=True)
+        finally:
+            importer.close()
+        conflicts = set(conflicts)
+        errors = [e for e in errors if e[0] not in conflicts] + importer.errors
+
+    n_files = sum(res['n_files'] for res in results)
+    echo(style("Imported ", bold=True)
+         + f"{n_files} files on {len(slices)} workers, "
+         + style(f"{len(errors)} errors", fg='red' if errors else 'green'))
+    for file_hash, message in errors:
+        echo(style(file_hash, dim=True)+" "+message)
+    return errors
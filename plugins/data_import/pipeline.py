@@ -0,0 +1,38 @@
+"""
+A bounded concurrent pipeline for extracting data tables from cloud storage.
+
+Object bodies are downloaded on a thread pool and workbooks are parsed on a
+process pool, while all database access stays on the calling thread. Results
+are handed back in the order that objects were listed, so a concurrent run
+processes files in the same sequence as a serial one.
+"""
+from collections import deque
+from concurrent.futures import Future
+
+
+def completed(value=None):
+    """A future that has already resolved to `value`"""
+    f = Future()
+    f.set_result(value)
+    return f
+
+
+def ordered_results(tasks, window):
+    """
+    Resolve an iterable of `(context, future)` pairs in submission order,
+    keeping at most `window` tasks in flight. Yields `(context, result)` pairs.
+
+    `tasks` is consumed lazily, so a generator that submits work as it is
+    iterated will never get more than `window` items ahead of the consumer.
+    """
+    pending = deque()
+    for task in tasks:
+        pending.append(task)
+        if len(pending) < window:
+            continue
+        context, future = pending.popleft()
+        yield context, future.result()
+
+    while pending:
+        context, future = pending.popleft()
+        yield context, future.result()
@@ -0,0 +1,157 @@
+"""
+Per-stage timing of import runs.
+
+Stages record wall and CPU time, and optionally the number of rows and bytes
+they handled, along with the file being imported. Reports are written as JSON
+(with a per-stage summary) or CSV. The slowest files can also be run under
+cProfile, with their stats dumped for inspection with `pstats` or snakeviz.
+"""
+import csv
+import json
+import cProfile
+import heapq
+import re
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from time import perf_counter, process_time
+from click import echo, style
+
+report_fields = ["file", "stage", "wall", "cpu", "rows", "bytes"]
+
+
+def timed_call(func, *args, **kwargs):
+    """
+    Call `func`, returning its result along with the wall and CPU time it
+    took. For work done in other processes, which can't record stages itself.
+    """
+    wall, cpu = perf_counter(), process_time()
+    res = func(*args, **kwargs)
+    return res, dict(wall=perf_counter() - wall, cpu=process_time() - cpu)
+
+
+class NullProfile(object):
+    """Stands in for `ImportProfile` when profiling is off"""
+    enabled = False
+
+    def stage(self, name, rows=None, nbytes=None, file=None):
+        return nullcontext(dict())
+
+    def file(self, key, name="total"):
+        return nullcontext(dict())
+
+    def extend(self, records):
+        pass
+
+    def add(self, name, timing, rows=None, nbytes=None, file=None):
+        pass
+
+
+class ImportProfile(object):
+    enabled = True
+
+    def __init__(self, n_slowest=0):
+        self.records = []
+        self.current_file = None
+        self.n_slowest = n_slowest
+        # Min-heap of (wall time, order, file, profile) for the slowest files
+        self._slowest = []
+
+    @contextmanager
+    def stage(self, name, rows=None, nbytes=None, file=None):
+        """
+        Time a stage. The yielded record can be updated with `rows` and
+        `bytes` once they are known. It is attributed to the current file
+        unless `file` is given.
+        """
+        if file is None:
+            file = self.current_file
+        rec = dict(file=file, stage=name, rows=rows, bytes=nbytes)
+        wall, cpu = perf_counter(), process_time()
+        try:
+            yield rec
+        finally:
+            rec['wall'] = perf_counter() - wall
+            rec['cpu'] = process_time() - cpu
+            self.records.append(rec)
+
+    @contextmanager
+    def file(self, key, name="total"):
+        """Time everything done for a single file, as the stage `name`"""
+        previous = self.current_file
+        self.current_file = key
+        prof = cProfile.Profile() if self.n_slowest > 0 else None
+        try:
+            with self.stage(name) as rec:
+                if prof is not None:
+                    prof.enable()
+                try:
+                    yield rec
+                finally:
+                    if prof is not None:
+                        prof.disable()
+        finally:
+            self.current_file = previous
+        if prof is not None:
+            self._keep_if_slow(rec['wall'], f"{name}-{key}", prof)
+
+    def _keep_if_slow(self, wall, key, prof):
+        item = (wall, len(self.records), key, prof)
+        if len(self._slowest) < self.n_slowest:
+            heapq.heappush(self._slowest, item)
+        else:
+            heapq.heappushpop(self._slowest, item)
+
+    def extend(self, records):
+        """Add stage records collected elsewhere, e.g. in a worker process"""
+        self.records.extend(records)
+
+    def add(self, name, timing, rows=None, nbytes=None, file=None):
+        """Add a stage timed elsewhere, with timing from `timed_call`"""
+        if file is None:
+            file = self.current_file
+        self.records.append(dict(file=file, stage=name, rows=rows, bytes=nbytes, **timing))
+
+    def summary(self):
+        """Totals for each stage, slowest first"""
+        totals = {}
+        for rec in self.records:
+            t = totals.setdefault(rec['stage'], dict(
+                stage=rec['stage'], calls=0, wall=0, cpu=0, rows=0, bytes=0))
+            t['calls'] += 1
+            for k in ('wall', 'cpu', 'rows', 'bytes'):
+                t[k] += rec[k] or 0
+        return sorted(totals.values(), key=lambda t: t['wall'], reverse=True)
+
+    def report(self):
+        echo(style(f"{'stage':24} {'calls':>7} {'wall (s)':>10} {'cpu (s)':>10} {'rows':>10} {'MB':>9}", bold=True),
+             err=True)
+        for t in self.summary():
+            echo(f"{t['stage']:24} {t['calls']:7} {t['wall']:10.3f} {t['cpu']:10.3f} "
+                 f"{t['rows']:10} {t['bytes']/1e6:9.2f}", err=True)
+
+    def write(self, path):
+        """
+        Write all stage records to `path`, as CSV if it ends in `.csv` and as
+        JSON otherwise. cProfile stats for the slowest files go in a directory
+        alongside it.
+        """
+        path = Path(path)
+        if path.suffix == ".csv":
+            with path.open("w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=report_fields)
+                writer.writeheader()
+                for rec in self.records:
+                    writer.writerow({k: rec.get(k) for k in report_fields})
+        else:
+            with path.open("w") as f:
+                json.dump(dict(stages=self.summary(), records=self.records), f, indent=2)
+        echo(f"Wrote profile to {path}", err=True)
+
+        if len(self._slowest) == 0:
+            return
+        dump_dir = path.parent / (path.stem + "-cprofile")
+        dump_dir.mkdir(exist_ok=True)
+        for wall, _, key, prof in sorted(self._slowest, reverse=True):
+            fn = dump_dir / (re.sub(r"[^\w.-]+", "_", str(key)) + ".prof")
+            prof.dump_stats(str(fn))
+            echo(f"- {wall:8.3f} s  {fn}", err=True)
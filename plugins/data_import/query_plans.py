@@ -0,0 +1,86 @@
+"""
+EXPLAIN-based checks that the queries made by the importers and the site
+can use the indexes added in `sql/extend-schema.sql`.
+
+Tables in a development database are often small enough that the planner
+prefers sequential scans, so by default they are disabled while checking.
+This tells us that an index is usable, not that it will always be chosen.
+"""
+import json
+from click import echo, style
+from sqlalchemy import text
+
+checks = [
+    ("data file by basename",
+     "SELECT file_hash FROM data_file WHERE basename = 'F-90_E2AgeCalc_DataTable.xlsx'",
+     "data_file_basename_idx"),
+    # Served by a unique constraint from Sparrow core, whose
+    # generated name starts with the table and column names
+    ("session by data file",
+     """SELECT s.id FROM session s
+        JOIN data_file_link l ON l.session_id = s.id
+        WHERE l.file_hash = '00000000000000000000000000000000' AND s.sample_id = 1""",
+     "data_file_link_file_hash"),
+    ("data files for session",
+     "SELECT file_hash FROM data_file_link WHERE session_id = 1",
+     "data_file_link_session_idx"),
+    ("sample by name",
+     "SELECT id FROM sample WHERE name = 'F-90'",
+     "sample_name_idx"),
+    ("accepted ages",
+     """SELECT d.value FROM datum d
+        JOIN datum_type dt ON d.type = dt.id
+        WHERE d.is_accepted AND dt.unit = 'Ma'""",
+     "datum_accepted_type_idx"),
+    ("project age histogram",
+     """SELECT ab.bucket, ab.count FROM lab_view.age_bucket ab
+        JOIN session s ON s.id = ab.session_id
+        WHERE s.project_id = 1 AND ab.resolution = 5""",
+     "session_project_idx"),
+    ("sample age histogram",
+     """SELECT ab.bucket, ab.count FROM lab_view.age_bucket ab
+        JOIN session s ON s.id = ab.session_id
+        WHERE s.sample_id = 1 AND ab.resolution = 5""",
+     "session_sample_idx"),
+]
+
+
+def index_names(plan):
+    """Names of all indexes used in a JSON query plan"""
+    names = set()
+    if "Index Name" in plan:
+        names.add(plan["Index Name"])
+    for child in plan.get("Plans", []):
+        names |= index_names(child)
+    return names
+
+
+def explain(conn, sql):
+    res = conn.execute(text("EXPLAIN (FORMAT JSON) " + sql)).scalar()
+    if isinstance(res, str):
+        res = json.loads(res)
+    return res[0]["Plan"]
+
+
+def check_query_plans(db, force_index=True):
+    """
+    Check that each query's plan uses its expected index, given by
+    name or name prefix.
+    Returns a list of `(name, expected index, indexes used)` for failed checks.
+    """
+    failed = []
+    conn = db.session.connection()
+    try:
+        if force_index:
+            conn.execute(text("SET LOCAL enable_seqscan = off"))
+        for name, sql, expected in checks:
+            used = index_names(explain(conn, sql))
+            ok = any(name.startswith(expected) for name in used)
+            mark = style("ok", fg="green") if ok else style("FAIL", fg="red")
+            echo(f"{mark:>4} {name:30} {expected}")
+            if not ok:
+                echo(style(f"     used: {', '.join(sorted(used)) or 'no indexes'}", dim=True))
+                failed.append((name, expected, used))
+    finally:
+        db.session.rollback()
+    return failed
@@ -3,49 +3,12 @@ from click import secho, echo, style
 from pandas import concat, to_numeric
 from click import secho
 import re
+from textwrap import wrap
 
 from sparrow.import_helpers import SparrowImportError
 
-def extract_analysis_name(sample_name):
-    sep = r"[\.\:_\s-]"
-
-    # We have something in the form "Spot xxx"
-    pat = sep+r"(Spot.+)$"
-    s = re.search(pat, str(sample_name), flags=re.IGNORECASE)
-    if s is not None:
-        return s.group(1)
-
-    # We just have a delimited last word (without a spot)
-    pat = sep+r"(\w+)$"
-    try:
-        s = re.search(pat, str(sample_name), flags=re.IGNORECASE)
-    except TypeError:
-        return None
-    if s is not None:
-        return s.group(1)
-
-    pat = sep+r"(\d+)$"
-    s = re.search(pat, str(sample_name))
-    if s is not None:
-        return s.group(1)
-    return None
-
-
-def remove_suffix(s1, s2):
-    try:
-        if s1.endswith(s2):
-            return s1[:-len(s2)]
-    except (TypeError, AttributeError):
-        pass
-    return s1
-
 delimiters = '.:_- '
 
-def strip_analysis_name(row):
-    s1 = row['analysis']
-    s2 = row['analysis_name']
-    return str(remove_suffix(s1, s2)).rstrip(delimiters)
-
 def print_sample_info(df, verbose=False):
     if verbose:
         echo(style("Samples: ", bold=True), err=True)
@@ -56,6 +19,59 @@ def print_sample_info(df, verbose=False):
     else:
         echo(style("Samples: ", bold=True)+"   ".join(data.sample_id.unique()), err=True)
 
+_sep = r"[\.\:_\s-]"
+# The analysis name is the suffix after the first separator that is followed
+# by "Spot..." or, failing that, by a single word. Each pattern captures the
+# sample name with its separator, the suffix, and whether the suffix is
+# followed by a newline (which `$` allows).
+_spot_pattern = re.compile(r"^((?s:.*?)"+_sep+r")(Spot.+)(\n?)\Z", flags=re.IGNORECASE)
+_word_pattern = re.compile(r"^((?s:.*?)"+_sep+r")(\w+)(\n?)\Z", flags=re.IGNORECASE)
+
+def split_analysis_names(analysis):
+    """Split a column of analysis ids into `(sample_name, analysis_name)`.
+       Only the delimiters in `delimiters` are stripped from the end of
+       sample names, so other whitespace before the suffix is kept."""
+    analysis = analysis.astype(str)
+    spot = analysis.str.extract(_spot_pattern)
+    word = analysis.str.extract(_word_pattern)
+    # A delimited trailing number is also a delimited trailing word,
+    # so we don't need a separate pattern for it
+    has_spot = spot[1].notnull()
+    analysis_name = spot[1].where(has_spot, word[1])
+    prefix = spot[0].where(has_spot, word[0])
+    # A suffix followed by a newline isn't at the end of the id,
+    # so the id is kept whole as the sample name
+    at_end = spot[2].where(has_spot, word[2]) == ""
+
+    matched = analysis_name.notnull()
+    sample_name = prefix.where(matched & at_end, analysis).str.rstrip(delimiters)
+    return sample_name, analysis_name.where(matched, None)
+
+def assign_sample_names(analysis):
+    """Sample and analysis names for a column of analysis ids, stripped
+       of delimiters. Returns `(sample_name, analysis_name)`."""
+    # Strip the analysis suffix off of the sample ID
+    sample_name, analysis_name = split_analysis_names(analysis)
+
+    # If we don't have enough unique suffixes, it's probable that we actually
+    # grabbed part of the sample ID. In that case, we fall back to the
+    # original sample id
+    suffixes = analysis_name.groupby(sample_name, sort=False)
+    n_unique = sample_name.map(suffixes.nunique(dropna=False))
+    n_rows = sample_name.map(sample_name.value_counts())
+    fallback = n_unique/n_rows < 0.4
+
+    # It appears we don't have a sample name, instead
+    spot = sample_name.str.startswith('Spot')
+
+    return (sample_name.where(~fallback, analysis).where(~spot, None),
+            analysis_name.where(~fallback, None).where(~spot, analysis))
+
+def session_indexes(analysis_name):
+    """Session index, if an integer can be found easily in the analysis name"""
+    cleaned_name = analysis_name.str.replace("Spot", "").str.strip(delimiters)
+    return to_numeric(cleaned_name, errors='coerce', downcast='integer')
+
 def generalize_samples(input):
     """Generalize sample ids into `sample_name`, `analysis_name`,
        and `session_index` columns"""
@@ -66,26 +82,7 @@ def generalize_samples(input):
 
     # Strip out extra data
     data['analysis'] = data['analysis'].str.strip(delimiters)
-    data['analysis_name'] = data['analysis'].apply(extract_analysis_name)
-    # Strip the analysis suffix off of the sample ID
-    data['sample_name'] = data.apply(strip_analysis_name, axis=1)
-
-    for sample_name, group in data.groupby(["sample_name"]):
-        unique_suffix = group['analysis_name'].unique()
-        # If we don't have enough unique suffixes, it's probable that we actually
-        # grabbed part of the sample ID. In that case, we fall back to the
-        # original sample id
-        ix = data['sample_name'] == sample_name
-        if len(unique_suffix)/len(group) < 0.4:
-            # Not many of our analysis names are unique, so we fall back
-            # to dealing with samples without internal enumeration
-            data.loc[ix, 'sample_name'] = data.loc[ix, 'analysis']
-            data.loc[ix, 'analysis_name'] = None
-
-        if sample_name.startswith('Spot'):
-            # It appears we don't have a sample name, instead
-            data.loc[ix, 'sample_name'] = None
-            data.loc[ix, 'analysis_name'] = data.loc[ix, 'analysis']
+    data['sample_name'], data['analysis_name'] = assign_sample_names(data['analysis'])
 
     n_samples = len(data['sample_name'].unique())
     if n_samples > 0.3*len(data) and n_samples > 20:
@@ -93,12 +90,7 @@ def generalize_samples(input):
         # sample IDs. We are probably doing something wrong.
         raise SparrowImportError("Too many unique samples; skipping import.")
 
-    # Session index is extracted if an integer can be found easily
-    cleaned_name = data['analysis_name'].str.replace("Spot", "").str.strip(delimiters)
-    data['session_index'] = to_numeric(
-        cleaned_name,
-        errors='coerce',
-        downcast='integer')
+    data['session_index'] = session_indexes(data['analysis_name'])
 
     print_sample_info(data, verbose=True)
 
@@ -107,12 +99,12 @@ def generalize_samples(input):
 def list_sample_names(data_files, verbose=False):
     """List sample names found in a set of CSV data tables, for debugging purposes."""
 
-    from .laserchron_importer import decode_datatable
+    from .laserchron_importer import load_datatable
 
     for i, file in enumerate(data_files):
         print(file.file_path)
         try:
-            df, meta = decode_datatable(file.csv_data)
+            df, meta = load_datatable(file)
             if verbose:
                 for line in wrap("  ".join([f"{i:20}" for i in df.index]), 80):
                     print(line)
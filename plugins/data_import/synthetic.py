@@ -0,0 +1,117 @@
+"""
+Synthetic LaserChron data tables for benchmarking.
+
+Tables are built from the header and analysis rows of the bundled test
+workbooks, scaled to a chosen number of spots, with analysis ids in the
+assorted forms found in real archives. Generation is seeded, so the same
+parameters always give the same archive.
+"""
+import string
+from hashlib import md5
+from random import Random
+from pandas import concat
+
+from sparrow.import_helpers import SparrowImportError
+
+from .extract_datatable import encode_datatable
+from .datatable_cache import decode_frame
+
+_separators = ["-", "_", " ", ".", ":"]
+
+
+def split_template(df):
+    """
+    Split a raw data table into the rows above its first analysis (title,
+    blank and header rows, as expected by `normalize_data`) and its analysis
+    rows. End matter such as footnotes is dropped.
+    """
+    start = 1 if str(df.iloc[0, 0]).startswith("Table") else 0
+    rows = df.iloc[start:].dropna(how='all')
+    first = df.index.get_loc(rows.index[3])
+    head, body = df.iloc[:first], rows.iloc[3:]
+
+    n_values = body.iloc[:, 1:].notnull().sum(axis=1)
+    body = body[n_values >= n_values.max()//2]
+    return head, body
+
+
+def load_templates(directory):
+    """Header and analysis rows of each readable workbook in `directory`"""
+    templates = []
+    for fn in sorted(directory.iterdir()):
+        if fn.suffix not in (".xls", ".xlsx"):
+            continue
+        try:
+            df = decode_frame(encode_datatable(fn))
+        except (SparrowImportError, NotImplementedError):
+            continue
+        templates.append((fn, *split_template(df)))
+    return templates
+
+
+def sample_name(rng):
+    """A sample name in one of the styles seen in the wild"""
+    letters = "".join(rng.choice(string.ascii_uppercase) for i in range(rng.randint(1, 4)))
+    number = str(rng.randint(1, 9999))
+    prefix = rng.choice(["", "", "ALC", "Zr", "18"])
+    return (prefix + rng.choice(["", "-"]) + letters
+            + rng.choice(["", "-", "_"]) + number + rng.choice(["", "", "a", "B"]))
+
+
+def analysis_ids(rng, name, n_spots):
+    """Analysis ids for the spots of a sample, with a per-sample naming style"""
+    sep = rng.choice(_separators)
+    style = rng.choice(["spot", "number", "padded"])
+    ids = []
+    for i in range(1, n_spots+1):
+        if style == "spot":
+            id = f"{name}{sep}Spot {i}"
+        elif style == "number":
+            id = f"{name}{sep}{i}"
+        else:
+            id = f"{name}{sep}{i:03d}"
+        # Stray markup and whitespace, as in real tables
+        if rng.random() < 0.02:
+            id += " <>"
+        if rng.random() < 0.02:
+            id = " "+id+" "
+        ids.append(id)
+    # A few repeated spots
+    for i in range(n_spots//100):
+        ids[rng.randrange(n_spots)] = ids[rng.randrange(n_spots)]
+    return ids
+
+
+def synthetic_table(rng, template, n_spots, max_samples=4):
+    """A raw data table with `n_spots` analyses drawn from a template"""
+    _, head, body = template
+    n_samples = min(rng.randint(1, max_samples), max(n_spots//10, 1))
+    sizes = [n_spots//n_samples]*n_samples
+    sizes[0] += n_spots - sum(sizes)
+
+    ids = []
+    for size in sizes:
+        ids += analysis_ids(rng, sample_name(rng), size)
+
+    rows = body.iloc[[rng.randrange(len(body)) for i in range(n_spots)]].copy()
+    rows[rows.columns[0]] = ids
+    return concat((head, rows)).reset_index(drop=True)
+
+
+def synthetic_archive(templates, n_files, min_spots=50, max_spots=1000, seed=0):
+    """
+    Generate `(key, raw data table)` pairs for a synthetic archive.
+    Tables are generated one at a time, so large archives are never held
+    in memory.
+    """
+    rng = Random(seed)
+    for i in range(n_files):
+        template = rng.choice(templates)
+        n_spots = rng.randint(min_spots, max_spots)
+        folder = rng.choice(["2019-04-12", "12 March 2018", "Jan 2020", "misc"])
+        key = f"synthetic/LaserChron Project {i % 20:02d}/{folder}/{i:05d}_{template[0].stem}.xls"
+        yield key, synthetic_table(rng, template, n_spots)
+
+
+def fake_hash(key):
+    return md5(key.encode()).hexdigest()
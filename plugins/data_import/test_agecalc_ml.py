@@ -0,0 +1,91 @@
+from pathlib import Path
+
+import numpy as N
+from h5py import File, ref_dtype
+from scipy.io import loadmat
+from pandas import concat
+from pandas.testing import assert_frame_equal
+from pytest import mark
+
+from .agecalc_ml import open_export, spot_names, spot_table, columns, _number
+
+test_export = Path(__file__).parent/"test-data"/"Test_Export_Nu.mat"
+
+
+def test_bundled_export():
+    H = loadmat(test_export, variable_names=["H"], squeeze_me=True,
+                struct_as_record=False, chars_as_strings=True)["H"]
+    samples = [str(v).strip() for v in N.atleast_1d(H.sample)]
+    # Empty cells are loaded as empty arrays, and placeholders are not numbers
+    best_ages = [_number(None if isinstance(v, N.ndarray) and v.size == 0 else v)
+                 for v in N.atleast_1d(H.Best_Age)]
+
+    with open_export(test_export) as export:
+        assert export.n_spots == len(samples) > 0
+        names = spot_names(export)
+        df, meta = spot_table(export, names, 0, export.n_spots)
+
+    assert len(df) == len(samples)
+    # Every spot is named, by sample, by analysis or both
+    sample_name = df.index.get_level_values("sample_name")
+    analysis_name = df.index.get_level_values("analysis_name")
+    assert (sample_name.notnull() | analysis_name.notnull()).all()
+    N.testing.assert_allclose(df['best_age'].values, best_ages, equal_nan=True)
+    assert meta.loc["Unit", "best_age"] == "Ma"
+
+
+def test_chunks_match_whole_export():
+    with open_export(test_export) as export:
+        names = spot_names(export)
+        whole, _ = spot_table(export, names, 0, export.n_spots)
+        chunks = [spot_table(export, names, start, min(start+7, export.n_spots))[0]
+                  for start in range(0, export.n_spots, 7)]
+    assert_frame_equal(concat(chunks), whole)
+
+
+spots = [
+    dict(sample="F-90-Spot 1", current_status="Accepted", Best_Age=115.4, STD1_idx=0),
+    dict(sample="F-90-Spot 2", current_status="Rejected", Best_Age=116.9, STD1_idx=0),
+    dict(sample="F-90-Spot 3", current_status="Accepted", Best_Age=N.nan, STD1_idx=0),
+    dict(sample="FC1-Spot 4", current_status="Accepted", Best_Age=1099.0, STD1_idx=1),
+]
+
+
+def write_hdf5_export(path, spots, shape):
+    """A MATLAB v7.3 style export: a struct of fields, with a cell array of
+       character arrays for text fields"""
+    fields = [field for field, unit in columns.values()] + ["STD1_idx", "STD2_idx"]
+    with File(path, "w") as f:
+        H = f.create_group("H")
+        refs = f.create_group("#refs#")
+        for field in ("sample", "current_status"):
+            cells = []
+            for i, spot in enumerate(spots):
+                chars = refs.create_dataset(f"{field}_{i}",
+                    data=N.array([[ord(c)] for c in spot[field]], dtype=N.uint16))
+                chars.attrs["MATLAB_class"] = N.bytes_("char")
+                cells.append(chars.ref)
+            ds = H.create_dataset(field, shape, dtype=ref_dtype)
+            ds[...] = N.array(cells, dtype=ref_dtype).reshape(shape)
+        for field in fields:
+            values = [float(spot.get(field, N.nan)) for spot in spots]
+            H.create_dataset(field, data=N.array(values).reshape(shape))
+    return path
+
+
+# Spots may be stored along either axis, depending on whether NuAgeCalc
+# saved a row or a column vector
+@mark.parametrize("shape", [(1, len(spots)), (len(spots), 1)])
+def test_hdf5_export(tmp_path, shape):
+    fn = write_hdf5_export(tmp_path/"export.mat", spots, shape)
+    with open_export(fn) as export:
+        assert export.n_spots == len(spots)
+        names = spot_names(export)
+        df, meta = spot_table(export, names, 1, 4)
+
+    assert list(df.index.get_level_values("sample_name")) == ["F-90", "F-90", "FC1"]
+    assert list(df.index.get_level_values("analysis_name")) == ["Spot 2", "Spot 3", "Spot 4"]
+    assert list(df.index.get_level_values("session_index")) == [2, 3, 4]
+    N.testing.assert_allclose(df['best_age'].values, [116.9, N.nan, 1099.0], equal_nan=True)
+    assert list(df['rejected']) == [True, False, False]
+    assert list(df['standard']) == [False, False, True]
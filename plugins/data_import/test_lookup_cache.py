@@ -0,0 +1,29 @@
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from .lookup_cache import LookupCache
+
+
+def test_rollback_drops_uncommitted_entries():
+    session = Session(bind=create_engine("sqlite://"))
+    cache = LookupCache()
+    cache.bind(session)
+    cache.put("unit", "Ma", "prewarmed")
+    cache.get("sample", "F-90", lambda: "committed")
+    session.commit()
+    cache.get("sample", "FC1", lambda: "rolled back")
+    session.rollback()
+
+    assert cache.has("unit", "Ma")
+    assert cache.has("sample", "F-90")
+    assert not cache.has("sample", "FC1")
+
+
+def test_unbind():
+    session = Session(bind=create_engine("sqlite://"))
+    cache = LookupCache()
+    cache.bind(session)
+    cache.unbind()
+    cache.get("sample", "FC1", lambda: "kept")
+    session.rollback()
+    assert cache.has("sample", "FC1")
@@ -0,0 +1,54 @@
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from uuid import UUID
+
+from .manifest import match_batch, hash_key
+
+digest = "0cc175b9c0f1b6a831c399e269772661"
+
+
+def record(**kwargs):
+    cols = dict(file_path=None, file_hash=None, file_etag=None, file_mtime=None)
+    cols.update(kwargs)
+    return SimpleNamespace(**cols)
+
+
+def listing(key, etag, modified=datetime(2020, 1, 1, tzinfo=timezone.utc)):
+    return dict(Key=key, ETag=f'"{etag}"', LastModified=modified)
+
+
+def test_hash_key_normalizes_forms():
+    assert hash_key(digest) == hash_key(UUID(digest)) == hash_key(str(UUID(digest)))
+    assert hash_key(digest+"-2") is None
+
+
+def test_moved_object_matched_by_etag():
+    # The record's hash is loaded from a uuid column, in dashed form
+    rec = record(file_path="old/a.xls", file_hash=str(UUID(digest)), file_etag=digest)
+    meta = listing("new/a.xls", digest)
+    by_hash = {hash_key(rec.file_hash): rec}
+    assert list(match_batch([meta], {}, by_hash)) == [(meta, rec)]
+
+
+def test_multipart_etag_not_matched_by_hash():
+    rec = record(file_hash=UUID(digest))
+    meta = listing("a.xls", digest+"-3")
+    assert list(match_batch([meta], {}, {hash_key(digest): rec})) == [(meta, None)]
+
+
+def test_changed_object_downloaded():
+    rec = record(file_path="a.xls", file_hash=UUID(digest), file_etag=digest)
+    meta = listing("a.xls", "92eb5ffee6ae2fec3ad71c777531578f")
+    assert list(match_batch([meta], {"a.xls": rec}, {})) == [(meta, None)]
+
+
+def test_mtime_fallback_compares_in_utc():
+    # Naive UTC timestamp from the database against an aware listing time
+    rec = record(file_path="a.xls", file_mtime=datetime(2020, 1, 1, 12))
+    meta = listing("a.xls", digest+"-2",
+        modified=datetime(2020, 1, 1, 12, tzinfo=timezone.utc))
+    assert list(match_batch([meta], {"a.xls": rec}, {})) == [(meta, rec)]
+
+    meta = listing("a.xls", digest+"-2",
+        modified=datetime(2020, 1, 1, 13, tzinfo=timezone.utc))
+    assert list(match_batch([meta], {"a.xls": rec}, {})) == [(meta, None)]
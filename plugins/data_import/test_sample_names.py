@@ -0,0 +1,182 @@
+import re
+from pathlib import Path
+from random import Random
+
+from pandas import Series, DataFrame, Index, to_numeric
+from pandas.testing import assert_frame_equal
+
+from sparrow.import_helpers import SparrowImportError
+
+from .extract_datatable import encode_datatable
+from .datatable_cache import decode_frame
+from .normalize_data import normalize_data
+from .sample_names import split_analysis_names, generalize_samples, delimiters
+from .synthetic import analysis_ids, sample_name
+
+test_data = Path(__file__).parent/"test-data"
+
+
+# The row-wise rules that `split_analysis_names` replaced, kept verbatim
+# as the reference for its output.
+def extract_analysis_name(sample_name):
+    sep = r"[\.\:_\s-]"
+
+    # We have something in the form "Spot xxx"
+    pat = sep+r"(Spot.+)$"
+    s = re.search(pat, str(sample_name), flags=re.IGNORECASE)
+    if s is not None:
+        return s.group(1)
+
+    # We just have a delimited last word (without a spot)
+    pat = sep+r"(\w+)$"
+    try:
+        s = re.search(pat, str(sample_name), flags=re.IGNORECASE)
+    except TypeError:
+        return None
+    if s is not None:
+        return s.group(1)
+
+    pat = sep+r"(\d+)$"
+    s = re.search(pat, str(sample_name))
+    if s is not None:
+        return s.group(1)
+    return None
+
+
+def remove_suffix(s1, s2):
+    try:
+        if s1.endswith(s2):
+            return s1[:-len(s2)]
+    except (TypeError, AttributeError):
+        pass
+    return s1
+
+
+def strip_analysis_name(row):
+    s1 = row['analysis']
+    s2 = row['analysis_name']
+    return str(remove_suffix(s1, s2)).rstrip(delimiters)
+
+
+def old_generalize_samples(input):
+    # As before vectorization, except that samples are grouped by a scalar
+    # key, which newer pandas versions give as a tuple for a list of keys
+    data = input.reset_index()
+    data.rename(columns={'Analysis': 'analysis'}, inplace=True)
+
+    # Strip out extra data
+    data['analysis'] = data['analysis'].str.strip(delimiters)
+    data['analysis_name'] = data['analysis'].apply(extract_analysis_name)
+    # Strip the analysis suffix off of the sample ID
+    data['sample_name'] = data.apply(strip_analysis_name, axis=1)
+
+    for sample_name, group in data.groupby("sample_name"):
+        unique_suffix = group['analysis_name'].unique()
+        ix = data['sample_name'] == sample_name
+        if len(unique_suffix)/len(group) < 0.4:
+            data.loc[ix, 'sample_name'] = data.loc[ix, 'analysis']
+            data.loc[ix, 'analysis_name'] = None
+
+        if sample_name.startswith('Spot'):
+            data.loc[ix, 'sample_name'] = None
+            data.loc[ix, 'analysis_name'] = data.loc[ix, 'analysis']
+
+    n_samples = len(data['sample_name'].unique())
+    if n_samples > 0.3*len(data) and n_samples > 20:
+        raise SparrowImportError("Too many unique samples; skipping import.")
+
+    cleaned_name = data['analysis_name'].str.replace("Spot", "").str.strip(delimiters)
+    data['session_index'] = to_numeric(
+        cleaned_name,
+        errors='coerce',
+        downcast='integer')
+
+    return data.set_index(["sample_name", "analysis_name", "session_index"], drop=True)
+
+
+def assert_same_generalized(data):
+    try:
+        expected = old_generalize_samples(data)
+    except SparrowImportError:
+        try:
+            generalize_samples(data)
+        except SparrowImportError:
+            return
+        raise AssertionError("Expected too many unique samples")
+    assert_frame_equal(generalize_samples(data).reset_index(), expected.reset_index())
+
+
+def table(ids):
+    """A data table with the given analysis ids, as output by `normalize_data`"""
+    return DataFrame({'value': range(len(ids))}, index=Index(ids, name='Analysis', dtype=object))
+
+
+def assert_same_names(analysis):
+    sample_name, analysis_name = split_analysis_names(analysis)
+    for i, id in enumerate(analysis):
+        name = extract_analysis_name(id)
+        expected = (strip_analysis_name(dict(analysis=id, analysis_name=name)), name)
+        assert (sample_name.iloc[i], analysis_name.iloc[i]) == expected, repr(id)
+
+
+def test_edge_cases():
+    assert_same_names(Series([
+        "ALC-18-1-Spot 12",
+        "ALC-18-1 Spot 12",
+        "Zr_123.5",
+        "sample:spot 3",
+        "NoDelimiter",
+        "A\tSpot 1",
+        "A\t 12",
+        "A-12\n",
+        "A-Spot 1\nB",
+        "A- -12",
+        "Spot 4",
+        "",
+        None,
+        float('nan'),
+    ], dtype=object))
+
+
+def test_synthetic_ids():
+    rng = Random(0)
+    ids = []
+    for i in range(200):
+        ids += analysis_ids(rng, sample_name(rng), 10)
+    analysis = Series(ids, dtype=object).str.strip(delimiters)
+    assert_same_names(analysis)
+
+
+def test_generalize_edge_cases():
+    # Spot-only names, samples that fall back to the whole id,
+    # and ids without a delimited suffix
+    assert_same_generalized(table(
+        ["Spot 1", "Spot 2", "Spot 3"]
+        + ["A-1", "A-1", "A-1", "A-1", "A-1"]
+        + ["B_Spot 1", "B_Spot 2", "B_Spot 10"]
+        + ["NoDelimiter", "C-x", "C-y"]))
+
+
+def test_generalize_synthetic_tables():
+    rng = Random(1)
+    for i in range(100):
+        ids = []
+        for j in range(rng.randint(1, 4)):
+            ids += analysis_ids(rng, sample_name(rng), rng.randint(1, 50))
+        assert_same_generalized(table(ids))
+
+
+def test_bundled_workbooks():
+    n_files = 0
+    for fn in sorted(test_data.iterdir()):
+        if fn.suffix not in (".xls", ".xlsx"):
+            continue
+        try:
+            data, meta = normalize_data(decode_frame(encode_datatable(fn, stem=fn.stem)))
+        except SparrowImportError:
+            continue
+        # As in `generalize_samples`
+        assert_same_names(data.index.to_series().str.strip(delimiters))
+        assert_same_generalized(data)
+        n_files += 1
+    assert n_files > 0
@@ -0,0 +1,84 @@
+from openpyxl import Workbook
+from pandas import DataFrame, isnull
+from pytest import fixture, raises
+
+from sparrow.import_helpers import SparrowImportError
+
+from .workbooks import read_datatable, find_age_table
+
+age_header = ["Analysis", "U (ppm)", "206Pb/238U", "Best age (Ma)", "± (Ma)"]
+age_units = [None, None, None, "Ma", "Ma"]
+ages = [
+    ["F-90-1", 250, 0.0181, 115.4, 1.2],
+    ["F-90-2", 310, 0.0179, "NA", 1.3],
+    ["F-90-3", 180, 0.0183, 116.9, None],
+]
+
+
+def write_workbook(path, sheets):
+    book = Workbook()
+    book.remove(book.active)
+    for name, rows in sheets.items():
+        sheet = book.create_sheet(name)
+        for row in rows:
+            sheet.append(row)
+    book.save(path)
+    return path
+
+
+@fixture
+def age_pick(tmp_path):
+    """An AGE PICK workbook, with notes above the age table on its second sheet"""
+    return write_workbook(tmp_path/"F-90 AGE PICK.xlsx", {
+        "Summary": [["Zircon U-Pb geochronologic analyses"]],
+        "Ages": [
+            ["Sample F-90"],
+            [],
+            ["Isotope ratios and apparent ages"],
+            age_header,
+            age_units,
+            *ages,
+        ],
+    })
+
+
+def test_find_age_table():
+    df = DataFrame([["notes", None], ["Best age", "±"], ["Ma", "Ma"], [100.0, 1.0]])
+    table = find_age_table(df)
+    assert table.iloc[0, 0] == "AGE PICK"
+    assert list(table.iloc[1]) == ["Best age", "±"]
+    assert len(table) == 4
+
+
+def test_find_age_table_without_header():
+    assert find_age_table(DataFrame([["notes"], [1.0]])) is None
+
+
+def test_read_age_pick(age_pick):
+    table = read_datatable(age_pick, stem=age_pick.stem)
+    # Laid out like a data table: title, two header rows and the analyses
+    assert table.iloc[0, 0] == "AGE PICK"
+    assert list(table.iloc[1]) == age_header
+    assert list(table.iloc[3:, 0]) == ["F-90-1", "F-90-2", "F-90-3"]
+    assert table.iloc[3, 3] == 115.4
+
+
+def test_xlsx_na_values(age_pick):
+    # As for .xls workbooks, "NA" and empty cells are missing values
+    table = read_datatable(age_pick, stem=age_pick.stem)
+    assert isnull(table.iloc[4, 3])
+    assert isnull(table.iloc[5, 4])
+    assert table.iloc[3:, 3].astype(float).notnull().sum() == 2
+
+
+def test_no_age_table(tmp_path):
+    fn = write_workbook(tmp_path/"F-90 AGE PICK.xlsx", {"Summary": [["No ages here"]]})
+    with raises(SparrowImportError):
+        read_datatable(fn, stem=fn.stem)
+
+
+def test_damaged_workbook(tmp_path):
+    fn = tmp_path/"damaged.xlsx"
+    fn.write_bytes(b"PK\x03\x04 not really a zip file")
+    with raises(SparrowImportError):
+        read_datatable(fn)
@@ -0,0 +1,141 @@
+"""
+Readers for the Excel workbooks that data tables are extracted from.
+
+Legacy `.xls` workbooks are read with xlrd, loading sheets on demand.
+`.xlsx` workbooks, which xlrd no longer reads, are read with openpyxl in
+read-only mode, so only the rows of the sheet we ask for are parsed. Both
+are read through `read_excel`, so that empty cells and markers such as "NA"
+are read as missing values in either format. The format is detected from
+the file's contents rather than its name.
+"""
+import re
+from io import BytesIO, IOBase
+from pandas import DataFrame, concat, read_excel
+from xlrd import open_workbook
+from openpyxl import load_workbook
+
+from sparrow.import_helpers import SparrowImportError
+
+XLSX_MAGIC = b"PK\x03\x04"
+
+# Increment this when changes to reading workbooks might succeed for files
+# that previously failed, so that those files are downloaded and extracted again.
+EXTRACTOR_VERSION = 2
+
+
+def _source(infile):
+    """Bytes or a filename for a workbook given as a file object,
+       bytes or a filename"""
+    if isinstance(infile, IOBase):
+        # We have an in-memory file
+        return infile.read()
+    if isinstance(infile, bytes):
+        return infile
+    # We have a filename
+    return str(infile)
+
+
+def _is_xlsx(source):
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            return f.read(len(XLSX_MAGIC)) == XLSX_MAGIC
+    return bytes(source[:len(XLSX_MAGIC)]) == XLSX_MAGIC
+
+
+class XLSReader(object):
+    def __init__(self, source):
+        if isinstance(source, str):
+            self.book = open_workbook(source, on_demand=True)
+        else:
+            self.book = open_workbook(file_contents=source, on_demand=True)
+
+    def sheet_names(self):
+        return self.book.sheet_names()
+
+    def read_sheet(self, name):
+        return read_excel(self.book, sheet_name=name, header=None)
+
+    def close(self):
+        self.book.release_resources()
+
+
+class XLSXReader(object):
+    def __init__(self, source):
+        self.source = source
+        self.book = load_workbook(self._open(), read_only=True, data_only=True)
+
+    def _open(self):
+        if isinstance(self.source, str):
+            return self.source
+        return BytesIO(self.source)
+
+    def sheet_names(self):
+        return self.book.sheetnames
+
+    def read_sheet(self, name):
+        # `read_excel` closes the workbook it reads, so it opens its own
+        # (read-only) copy, and ours stays open for listing sheets
+        return read_excel(self._open(), sheet_name=name, header=None, engine="openpyxl")
+
+    def close(self):
+        self.book.close()
+
+
+def open_workbook_reader(infile):
+    """Open a workbook with the reader for its format"""
+    try:
+        source = _source(infile)
+        if _is_xlsx(source):
+            return XLSXReader(source)
+        return XLSReader(source)
+    except Exception as err:
+        raise SparrowImportError(f"Could not open workbook: {type(err).__name__}: {err}")
+
+
+_best_age = re.compile(r"^\s*best\s+age", flags=re.IGNORECASE)
+
+
+def find_age_table(df):
+    """
+    Find the age table in a sheet of an AGE PICK workbook, whose first
+    header row is the one with a "Best age" column. Returns the table laid
+    out like a data table: a title row, two header rows and the analyses.
+    """
+    is_header = df.apply(lambda col: col.astype(str).str.contains(_best_age)).any(axis=1)
+    if not is_header.any():
+        return None
+    start = is_header.values.argmax()
+    title = DataFrame([["AGE PICK"]], columns=df.columns[:1])
+    return concat((title, df.iloc[start:]), ignore_index=True)
+
+
+def read_age_pick(reader):
+    """Age table from the first sheet of an AGE PICK workbook that has one"""
+    for name in reader.sheet_names():
+        table = find_age_table(reader.read_sheet(name))
+        if table is not None:
+            return table
+    raise SparrowImportError("No age table in AGE PICK workbook")
+
+
+def read_datatable(infile, stem=""):
+    """
+    The `datatable` sheet of a workbook as a raw data frame, or the age table
+    of an AGE PICK workbook.
+    """
+    reader = open_workbook_reader(infile)
+    try:
+        if "datatable" in reader.sheet_names():
+            return reader.read_sheet("datatable")
+        if "AGE PICK" in stem:
+            return read_age_pick(reader)
+        raise SparrowImportError("No data table")
+    except SparrowImportError:
+        raise
+    except Exception as err:
+        # Readers raise all sorts of errors for damaged or unexpected
+        # workbooks (e.g. KeyError or BadZipFile from openpyxl), which
+        # are recorded as failed extractions like any other.
+        raise SparrowImportError(f"Could not open data table: {type(err).__name__}: {err}")
+    finally:
+        reader.close()
@@ -1,12 +1,15 @@
 from sparrow.plugins import SparrowPlugin
 from sparrow.context import app_context
-from .cli import import_laserchron_metadata
-from .utils import material_check
+from .cli import import_laserchron_metadata, benchmark_laserchron_metadata
+from .bulk_load import bulk_load_samples
+from .provenance import diff_rows, record_hashes
+from .coordinates import parse_coordinates
+from .utils import ensure_materials, chunks, update_samples
+from ..data_import.profiling import ImportProfile, NullProfile
 
 from pathlib import Path
 import pandas as pd
 import click
-from IPython import embed
 
 def space(spaces=1):
     for i in range(0, spaces):
@@ -20,15 +23,12 @@ def failed_import(name:str, e):
 class LaserChronMetadataImporter(SparrowPlugin):
 
     name = "laserchron-metadata"
-    minutes_tick = "′"
-    degree_symbol = "°"
+    chunk_size = 500
 
-    def iterfiles(self, filename):
+    def read_samples(self, filename):
         """
-        Read in csv and perform some data cleaning 
+        Read in csv and perform some data cleaning, returning sample dicts ready for loading
         """
-        db = app_context().database
-
         here = Path(__file__).parent
         fn = here / filename
 
@@ -38,65 +38,159 @@ class LaserChronMetadataImporter(SparrowPlugin):
 
         df = df[df['Sample ID'].notna()]
 
-        df['Longitude'] = df['Longitude'].apply(self.clean_long_lat_to_float)
-        df['Latitude'] = df['Latitude'].apply(self.clean_long_lat_to_float)
+        df['Longitude'], lon_parsed = parse_coordinates(df['Longitude'], limit=180)
+        df['Latitude'], lat_parsed = parse_coordinates(df['Latitude'], limit=90)
+
+        parsed = lon_parsed & lat_parsed
+        if not parsed.all():
+            click.secho(f"Skipping {(~parsed).sum()} samples without parseable coordinates", fg="yellow")
+        df = df[parsed]
+
+        return self.create_sample_dict(df)
+
+    def iterfiles(self, filename, bulk=True, dry_run=False, profile=None, profile_slowest=0):
+        """
+        Import sample metadata from a csv. Only rows that are new or changed since the
+        last import are touched. New samples are loaded in a single transaction
+        unless `bulk` is False, in which case they are loaded one at a time.
+        With `dry_run`, only report which rows would be imported.
+        If a `profile` path is given, the time spent in each stage is written to it.
+        """
+        prof = NullProfile()
+        if profile is not None:
+            prof = ImportProfile(n_slowest=profile_slowest)
+
+        with prof.file(filename):
+            self._iterfiles(filename, bulk=bulk, dry_run=dry_run, profile=prof)
+
+        if profile is not None:
+            prof.report()
+            prof.write(profile)
+
+    def _iterfiles(self, filename, bulk=True, dry_run=False, profile=NullProfile()):
+        db = app_context().database
+
+        with profile.stage("read_samples") as stage:
+            rows = self.read_samples(filename)
+            stage['rows'] = len(rows)
+
+        with profile.stage("diff_rows", rows=len(rows)):
+            diff = diff_rows(db, rows, filename)
+        self.report_diff(diff, verbose=dry_run)
+        if dry_run:
+            return
+
+        changed = diff['new'] + diff['changed']
+        json_list = [row for _, _, row in changed]
 
-        df = self.drop_unparseable_coord(df)
+        with profile.stage("ensure_materials", rows=len(json_list)):
+            new_materials = ensure_materials(db, [row['material'] for row in json_list])
+        if len(new_materials) > 0:
+            click.secho(f"Added {len(new_materials)} new materials: {', '.join(new_materials)}", fg="blue")
 
-        json_list = self.create_sample_dict(df)
-        json_list, number_existing = self.check_if_exists(json_list)
+        with profile.stage("check_if_exists", rows=len(json_list)):
+            new_items, sample_ids, number_existing = self.check_if_exists(changed)
 
-        total_samples= len(json_list)
+        total_samples= len(new_items)
 
         successfully_imported = 0
 
-        for ele in json_list:
+        if bulk:
             try:
-                db.load_data('sample', ele)
-                click.secho(f"Inserting sample {ele['name']}", fg="green")
-                successfully_imported += 1
+                with profile.stage("bulk_load", rows=len(new_items)):
+                    ids = bulk_load_samples(db, [row for _, _, row in new_items])
+                    db.session.commit()
+                successfully_imported = len(ids)
+                sample_ids.update((key, id) for (key, _, _), id in zip(new_items, ids))
             except Exception as e:
-                failed_import(ele['name'], e)
+                db.session.rollback()
+                click.secho(" Failed Import! ", fg="white", bg="red")
+                click.secho(f"No new samples were imported from {filename}", fg="red")
+                click.secho(f"Error: {e}", fg="yellow")
+        else:
+            for key, _, ele in new_items:
+                try:
+                    with profile.stage("load_data", rows=1):
+                        sample = db.load_data('sample', ele)
+                    click.secho(f"Inserting sample {ele['name']}", fg="green")
+                    sample_ids[key] = sample.id
+                    successfully_imported += 1
+                except Exception as e:
+                    failed_import(ele['name'], e)
+
+        # Failed rows are left unrecorded so that they are retried next time
+        with profile.stage("record_hashes"):
+            record_hashes(db, [(key, hash, sample_ids[key])
+                for key, hash, _ in changed if key in sample_ids], filename)
         
         click.secho("Finished Importing Metadata", fg="bright_green")
         click.secho(f"{number_existing} samples already existed and checked for new metadata.", fg="bright_green")
         click.secho(f"{successfully_imported}/{total_samples} successfully imported!", fg="bright_green")
 
+    def report_diff(self, diff, verbose=False):
+        """ Summarize which csv rows are new, changed, unchanged or removed since the last import """
+        colors = dict(new="green", changed="yellow", unchanged="white", removed="red")
+        for kind, color in colors.items():
+            click.secho(f"{len(diff[kind])} {kind} rows", fg=color)
+            if not verbose or kind == "unchanged":
+                continue
+            for item in diff[kind]:
+                name, occurrence = item if kind == "removed" else item[0]
+                suffix = f" (#{occurrence+1})" if occurrence > 0 else ""
+                click.secho(f"  {name}{suffix}", fg=color, dim=True)
+
 
-    def check_if_exists(self, json_list):
+    def check_if_exists(self, items):
         """ 
-        Check if sample exists in the database and if it does add the additional metadata
+        Check if samples exist in the database and if they do add the additional metadata.
+        Samples are looked up and updated in chunks rather than one at a time.
+        Takes `(key, hash, row)` tuples, and returns the tuples for new samples,
+        the ids of the updated samples by key, and the number of existing samples.
         """
         db = app_context().database
         Sample = db.model.sample
 
-        samples_that_exist = []
-        for inx, row in enumerate(json_list):
-            name = row['name']
-            res = db.session.query(Sample).filter_by(name=name).all()
-            material_check(db, row['material'])
-            if len(res) > 0:
-                ## sample already exists
-                samples_that_exist.append(inx)
-                existing = res[0]
-                for k,v in row.items():
-                    if k == "location":
-                        #'SRID=4269;POINT(-71.064544 42.28787)'
-                        v = f"SRID=4269;POINT({v['coordinates'][0]} {v['coordinates'][1]})"
-                    setattr(existing, k, v)
-
-                assert len(db.session.dirty) > 0
-                
+        new_items = []
+        sample_ids = {}
+        failed = []
+        for chunk in chunks(items, self.chunk_size):
+            names = [row['name'] for _, _, row in chunk]
+            existing = {}
+            for id, name in db.session.query(Sample.id, Sample.name).filter(Sample.name.in_(names)):
+                # Only the first match is updated, as with duplicate sample names before
+                existing.setdefault(name, id)
+
+            updates = []
+            keys = []
+            for key, hash, row in chunk:
+                if row['name'] in existing:
+                    updates.append((existing[row['name']], row))
+                    keys.append(key)
+                else:
+                    new_items.append((key, hash, row))
+
+            try:
+                update_samples(db, updates)
+                db.session.commit()
+                sample_ids.update((key, id) for key, (id, _) in zip(keys, updates))
+                continue
+            except Exception:
+                db.session.rollback()
+
+            # Find the samples that are causing trouble
+            for key, update in zip(keys, updates):
                 try:
-                    click.secho(f"{name} already exists, adding missing metadata..", fg="yellow")
+                    update_samples(db, [update])
                     db.session.commit()
+                    sample_ids[key] = update[0]
                 except Exception as e:
-                    failed_import(name, e)
+                    failed_import(update[1]['name'], e)
                     db.session.rollback()
-        for i in reversed(samples_that_exist): # reverse so indexes stay in correct place
-            del json_list[i]
+                    failed.append(update[1]['name'])
+
+        click.secho(f"{len(sample_ids)} existing samples updated with metadata, {len(failed)} failed", fg="yellow")
         
-        return json_list, len(samples_that_exist)
+        return new_items, sample_ids, len(sample_ids) + len(failed)
 
     def create_sample_dict(self, df):
         """ Create sample dictionary ready for loading """
@@ -130,90 +224,6 @@ class LaserChronMetadataImporter(SparrowPlugin):
             Case: more than one in cell separated by a '/'
         """
     
-    def clean_long_lat_to_float(self, coordinate):
-        """ 
-        Checks for a few cases where the long/lat value isn't float-parseable 
-
-        returns coordinate as decimal float
-        """
-
-        coordinate_str = str(coordinate)
-
-        if coordinate_str == 'nan':
-            return None
-
-        unformatted_str, is_neg = self.sign_check(coordinate_str)
-        if self.degree_symbol in coordinate_str:
-            if self.minutes_tick in unformatted_str:
-                # parse out 87°30′00′′ --> 87.5
-                coordinate_float = self.clean_non_decimal_string(unformatted_str)
-            else:
-                # remove degree symbol which is MOST likely at the end
-                unformatted_str = unformatted_str[:-1] 
-                coordinate_float = float(unformatted_str)
-        else:
-            try:
-                coordinate_float = float(unformatted_str)
-            except:
-                return coordinate
-        if is_neg and coordinate_float > 0:
-            coordinate_float = coordinate_float * -1
-        return coordinate_float
-    
-    def to_decimal(self, degrees, minutes, seconds):
-        """ turns degrees° min′ sec′′ to decimal style coordinate """
-        return degrees + minutes/60 + seconds/3600
-
-    def clean_non_decimal_string(self, unformatted_str):
-        """ function to turn degree to a decimal formatted coordinate """
-
-        degrees, min_sec, *rest =  tuple(unformatted_str.split(self.degree_symbol))
-        minutes, seconds, *rest = tuple(min_sec.split(self.minutes_tick))
-
-        return self.to_decimal(int(degrees), int(minutes), int(seconds))
-
-    def sign_check(self, unformatted_str):
-        """ 
-        Takes an unformatted coordinate string and checks if one of the cardinal directions is in it.cardinal_direction_to_sign
-
-        Removes the letter from the unformatted string and returns it and a bool indicated whether it's negative or not.
-
-        Will also check for a minus sign
-
-        returns (unformatted_string, boolean)
-        """
-
-        letters= ['N','S','E','W']
-        neg = ['S','W']
-
-        is_neg = False
-
-        if unformatted_str[0] == '-':
-            is_neg = True
-
-        for l in letters:
-            if l in unformatted_str:
-                unformatted_str = unformatted_str.replace(l, '')
-                if l in neg:
-                    is_neg = True
-
-        return unformatted_str, is_neg
-    
-    def drop_unparseable_coord(self, df):
-        """ 
-            Loop through coordinate columns and 
-            remove those that aren't float parseable 
-        """
-        unparseable_indexes = []
-        for index,row in df.iterrows():
-            try:
-                float(row['Longitude'])
-            except:
-                unparseable_indexes.append(index)
-        
-        df.drop(index=unparseable_indexes, inplace=True)
-
-        return df
-    
     def on_setup_cli(self, cli):
         cli.add_command(import_laserchron_metadata)
+        cli.add_command(benchmark_laserchron_metadata)
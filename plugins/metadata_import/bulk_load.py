@@ -0,0 +1,119 @@
+"""
+Set-based loading of new samples from a metadata CSV.
+
+Sample dicts are staged into a temporary table with COPY, and geo entities,
+samples and their geo entity links are each created with a single statement.
+This produces the same rows as calling `db.load_data('sample', ...)` per
+sample, in one transaction. Materials must already be in the vocabulary
+(see `ensure_materials`), and the caller is responsible for committing.
+"""
+from io import StringIO
+from sqlalchemy import text
+
+staged_columns = ("ord", "name", "material", "longitude", "latitude",
+                  "geo_entity_name", "geo_entity_description")
+
+create_staging_table = """
+CREATE TEMPORARY TABLE staged_sample (
+    ord integer PRIMARY KEY,
+    name text,
+    material text,
+    longitude double precision,
+    latitude double precision,
+    geo_entity_name text,
+    geo_entity_description text,
+    sample_id integer
+) ON COMMIT DROP
+"""
+
+load_statements = [
+    # Geo entities that don't exist yet
+    """
+    INSERT INTO geo_entity (name, description)
+    SELECT DISTINCT s.geo_entity_name, s.geo_entity_description
+    FROM staged_sample s
+    WHERE s.geo_entity_name IS NOT NULL
+      AND NOT EXISTS (
+        SELECT 1 FROM geo_entity g
+        WHERE g.name = s.geo_entity_name
+          AND g.description IS NOT DISTINCT FROM s.geo_entity_description)
+    """,
+    # Reserve ids so that geo entity links can be made without matching on name
+    """
+    UPDATE staged_sample
+    SET sample_id = nextval(pg_get_serial_sequence('sample', 'id'))
+    """,
+    """
+    INSERT INTO sample (id, name, material, location)
+    SELECT sample_id, name, material,
+        ST_SetSRID(ST_MakePoint(longitude, latitude), 4269)
+    FROM staged_sample
+    ORDER BY ord
+    """,
+    """
+    INSERT INTO sample_geo_entity (sample_id, geo_entity_id)
+    SELECT s.sample_id, g.id
+    FROM staged_sample s
+    JOIN LATERAL (
+        SELECT id FROM geo_entity g
+        WHERE g.name = s.geo_entity_name
+          AND g.description IS NOT DISTINCT FROM s.geo_entity_description
+        ORDER BY id
+        LIMIT 1
+    ) g ON true
+    ORDER BY s.ord
+    """,
+]
+
+
+def staged_row(ord, sample):
+    """Flatten a sample dict as built by `create_sample_dict` to a staging table row"""
+    lon, lat = None, None
+    if sample.get('location') is not None:
+        lon, lat = sample['location']['coordinates']
+    geo_entity = {}
+    for link in sample.get('sample_geo_entity', []):
+        geo_entity = link['geo_entity']
+    return (ord, sample['name'], sample.get('material'), lon, lat,
+            geo_entity.get('name'), geo_entity.get('description'))
+
+
+def _csv_field(value):
+    # Strings are always quoted, so that only unquoted empty fields are NULL
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return '"' + value.replace('"', '""') + '"'
+    if isinstance(value, float):
+        # Also covers numpy floats, whose repr isn't a plain number
+        return repr(float(value))
+    return str(value)
+
+
+def copy_samples(conn, samples):
+    """COPY sample dicts into the staging table"""
+    buf = StringIO()
+    for i, sample in enumerate(samples):
+        buf.write(",".join(_csv_field(v) for v in staged_row(i, sample)) + "\n")
+    buf.seek(0)
+
+    cursor = conn.connection.cursor()
+    cursor.copy_expert(
+        f"COPY staged_sample ({', '.join(staged_columns)}) FROM STDIN WITH (FORMAT csv)",
+        buf)
+
+
+def bulk_load_samples(db, samples):
+    """
+    Insert new samples with their geo entities.
+    Returns the ids of the inserted samples, in the order they were given.
+    """
+    if len(samples) == 0:
+        return []
+    conn = db.session.connection()
+    conn.execute(text(create_staging_table))
+    copy_samples(conn, samples)
+    for stmt in load_statements:
+        conn.execute(text(stmt))
+    res = conn.execute(text("SELECT sample_id FROM staged_sample ORDER BY ord"))
+    return [id for id, in res]
@@ -1,18 +1,57 @@
-from click import command, option, secho
+from click import command, option, secho, echo, Path
 from sparrow.cli.util import with_app
+from time import perf_counter
 from sparrow.task_manager import task
 import sparrow
 
+from .bulk_load import bulk_load_samples
+from .utils import ensure_materials
+
 @command(name="import-laserchron-metadata")
 @option('--filename', '--fn', default='alc_metadata.csv')
+@option('--bulk/--no-bulk', default=True, help="Load new samples in a single set-based transaction")
+@option('--dry-run', is_flag=True, default=False, help="Show which rows are new, changed, unchanged or removed without importing")
+@option('--profile', type=Path(dir_okay=False), default=None, help="Write per-stage timings to a JSON (or .csv) report")
+@option('--profile-slowest', type=int, default=0, help="Also write a cProfile dump of the import")
 @with_app
-def import_laserchron_metadata(app, filename):
+def import_laserchron_metadata(app, filename, bulk=True, dry_run=False, profile=None, profile_slowest=0):
     """ 
     import laserchron metadata from downloaded csv
     """
 
     MetadataImporter = app.plugins.get("laserchron-metadata")
-    MetadataImporter.iterfiles(filename)
+    MetadataImporter.iterfiles(filename, bulk=bulk, dry_run=dry_run,
+                               profile=profile, profile_slowest=profile_slowest)
+
+@command(name="benchmark-laserchron-metadata")
+@option('--filename', '--fn', default='alc-2022-03-14.csv')
+@with_app
+def benchmark_laserchron_metadata(app, filename):
+    """
+    Time the stages of a bulk metadata import. Every sample is loaded
+    as if it were new, and the load is rolled back.
+    """
+    MetadataImporter = app.plugins.get("laserchron-metadata")
+    db = app.database
+
+    start = perf_counter()
+    json_list = MetadataImporter.read_samples(filename)
+    read_time = perf_counter() - start
+
+    # As in the import, materials are added before samples are loaded
+    ensure_materials(db, [row['material'] for row in json_list])
+
+    start = perf_counter()
+    try:
+        n_samples = len(bulk_load_samples(db, json_list))
+        db.session.flush()
+    finally:
+        db.session.rollback()
+    load_time = perf_counter() - start
+
+    echo(f"{n_samples} samples from {filename}")
+    echo(f"read and parse: {read_time:8.3f} s")
+    echo(f"bulk load:      {load_time:8.3f} s")
 
 @task(name="import-laserchron-metadata")
 def import_laserchron_metdata_(filename:str = "alc_metadata.csv"):
@@ -0,0 +1,61 @@
+"""
+Vectorized parsing of the coordinate formats found in metadata spreadsheets.
+
+Handles plain decimal degrees, signed values (including the unicode minus),
+cardinal directions before or after the value, a trailing degree symbol,
+and degree/minute/second forms like `87°30′00′′` or `84 21.187`.
+"""
+import pandas as pd
+import numpy as N
+
+_number = r"\d+(?:\.\d*)?|\.\d+"
+
+coordinate_regex = (
+    r"^\s*(?P<prefix>[NSEW])?\s*"
+    r"(?P<sign>[-+−])?\s*"
+    rf"(?P<deg>{_number})\s*°?"
+    rf"(?:\s*(?P<min>{_number})\s*['′]?"
+    rf"(?:\s*(?P<sec>{_number})\s*(?:″|′′|''|\")?)?)?"
+    r"\s*(?P<suffix>[NSEW])?\s*$"
+)
+
+
+def _is_integer(values):
+    return values.isnull() | (values == N.floor(values))
+
+
+def parse_coordinates(values, limit=None):
+    """
+    Parse a column of coordinates to decimal degrees.
+
+    Returns `(coordinates, parsed)`: a float series that is NaN where a value
+    couldn't be parsed, and a boolean mask of the values that were. If `limit`
+    is given, values with a larger magnitude are treated as unparseable.
+    """
+    values = pd.Series(values)
+    coordinates = pd.to_numeric(values, errors='coerce')
+
+    # Only values that aren't already numbers need to go through the regex
+    text = values[coordinates.isnull() & values.notnull()].astype(str)
+    if len(text) > 0:
+        parts = text.str.extract(coordinate_regex)
+        deg, mins, secs = (pd.to_numeric(parts[k]) for k in ('deg', 'min', 'sec'))
+
+        valid = deg.notnull()
+        # Minutes and seconds only make sense after whole degrees and minutes
+        valid &= mins.isnull() | (_is_integer(deg) & (mins < 60))
+        valid &= secs.isnull() | (_is_integer(mins) & (secs < 60))
+        # A value can't have a direction on both sides
+        valid &= parts['prefix'].isnull() | parts['suffix'].isnull()
+
+        decimal = deg + mins.fillna(0)/60 + secs.fillna(0)/3600
+        direction = parts['prefix'].fillna(parts['suffix'])
+        is_neg = parts['sign'].isin(['-', '−']) | direction.isin(['S', 'W'])
+        decimal = decimal.where(~is_neg, -decimal)
+
+        coordinates.loc[text.index] = decimal.where(valid)
+
+    parsed = coordinates.notnull()
+    if limit is not None:
+        parsed &= coordinates.abs() <= limit
+    return coordinates.where(parsed), parsed
@@ -0,0 +1,85 @@
+"""
+Content hashes of imported metadata CSV rows.
+
+Rows are keyed by source file, sample name and by how many rows with the
+same name come before them in the file, since sample names are not unique in
+the CSVs. Re-running an import of a file compares each row's hash against the
+one recorded when it was last imported from that file, so that only new and
+changed rows are touched.
+"""
+import json
+from hashlib import md5
+from collections import defaultdict
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+
+from .utils import chunks
+
+
+def row_hash(row):
+    """Hash of a sample dict as built by `create_sample_dict`"""
+    content = json.dumps(row, sort_keys=True, default=str)
+    return md5(content.encode()).hexdigest()
+
+
+def row_keys(rows):
+    """(sample name, occurrence) keys for each row"""
+    seen = defaultdict(int)
+    keys = []
+    for row in rows:
+        keys.append((row['name'], seen[row['name']]))
+        seen[row['name']] += 1
+    return keys
+
+
+def diff_rows(db, rows, source_file):
+    """
+    Compare rows against the hashes recorded for `source_file`. Returns a
+    dict of lists of `(key, hash, row)` tuples for new, changed and unchanged
+    rows, and a list of the keys that were recorded but are no longer in the file.
+    """
+    Provenance = db.model.sample_metadata_import
+    q = (db.session.query(
+            Provenance.sample_name, Provenance.occurrence, Provenance.row_hash)
+        .filter(Provenance.source_file == source_file))
+    previous = {(name, occurrence): hash for name, occurrence, hash in q}
+
+    diff = dict(new=[], changed=[], unchanged=[], removed=[])
+    keys = row_keys(rows)
+    for key, row in zip(keys, rows):
+        hash = row_hash(row)
+        if key not in previous:
+            diff['new'].append((key, hash, row))
+        elif previous[key] != hash:
+            diff['changed'].append((key, hash, row))
+        else:
+            diff['unchanged'].append((key, hash, row))
+    diff['removed'] = sorted(set(previous) - set(keys))
+    return diff
+
+
+def record_hashes(db, items, source_file, chunk_size=500):
+    """
+    Record hashes for imported `(key, hash, sample id)` tuples, where the
+    sample id is the one the row was inserted as or updated.
+    """
+    Provenance = db.model.sample_metadata_import
+
+    for chunk in chunks(items, chunk_size):
+        values = [dict(
+                source_file=source_file,
+                sample_name=name,
+                occurrence=occurrence,
+                sample_id=sample_id,
+                row_hash=hash)
+            for (name, occurrence), hash, sample_id in chunk]
+
+        stmt = insert(Provenance.__table__).values(values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['source_file', 'sample_name', 'occurrence'],
+            set_=dict(
+                sample_id=stmt.excluded.sample_id,
+                row_hash=stmt.excluded.row_hash,
+                imported=func.now()))
+        db.session.execute(stmt)
+    db.session.commit()
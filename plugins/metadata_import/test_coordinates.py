@@ -0,0 +1,81 @@
+import numpy as N
+from pandas import Series
+
+from .coordinates import parse_coordinates
+
+nan = float('nan')
+
+# Values as they appear in the metadata spreadsheets, with the expected
+# decimal degrees (NaN where the value can't be parsed)
+latitudes = [
+    # Decimal degrees
+    (44.13143, 44.13143),
+    ("-45.5", -45.5),
+    ("44.131430°", 44.13143),
+    ("-26.944013°", -26.944013),
+    # Hemisphere letters
+    ("N 32.13383", 32.13383),
+    ("12.5S", -12.5),
+    ("28°15′00′′N", 28.25),
+    # Degrees and decimal minutes, or degrees, minutes and seconds
+    ("28 22.124", 28 + 22.124/60),
+    ("59 19 49", 59 + 19/60 + 49/3600),
+    # Blank and invalid values
+    (None, nan),
+    ("", nan),
+    ("N/A", nan),
+    ("Malta, MT", nan),
+    # Latitude and longitude in the same cell
+    ("63.407981 145.95913", nan),
+    # A stray space after the decimal point reads as 820462 minutes
+    ("31. 820462", nan),
+    # A direction on both sides
+    ("N 10 S", nan),
+    # Out of range
+    ("91", nan),
+]
+
+longitudes = [
+    ("-106.917548°", -106.917548),
+    ("−110.79099", -110.79099),
+    ("W 105.43294", -105.43294),
+    ("87°30′00′′E", 87.5),
+    ("135 21 38", 135 + 21/60 + 38/3600),
+    ("83 38.367", 83 + 38.367/60),
+    # A second decimal point, or 157 seconds
+    ("-148.51.268", nan),
+    ("83.38.679", nan),
+    ("84 21 157", nan),
+    ("200", nan),
+]
+
+
+def assert_parsed(cases, limit):
+    values, expected = zip(*cases)
+    coordinates, parsed = parse_coordinates(Series(values, dtype=object), limit=limit)
+    N.testing.assert_allclose(coordinates.values, expected, equal_nan=True)
+    assert list(parsed) == [not N.isnan(v) for v in expected]
+
+
+def test_latitudes():
+    assert_parsed(latitudes, 90)
+
+
+def test_longitudes():
+    assert_parsed(longitudes, 180)
+
+
+def test_without_limit():
+    coordinates, parsed = parse_coordinates(Series(["200", "W 200"], dtype=object))
+    assert list(coordinates) == [200, -200]
+    assert parsed.all()
+
+
+def test_dropped_point():
+    # As in `read_samples`, a sample is only kept if both coordinates parse.
+    # HC-062407-08 has a valid latitude but a longitude with two decimal points.
+    lon, lon_parsed = parse_coordinates(Series(["-148.51.268", "W 105.43294"]), limit=180)
+    lat, lat_parsed = parse_coordinates(Series(["63.51709", "N 32.13383"]), limit=90)
+    assert list(lon_parsed & lat_parsed) == [False, True]
+    assert lat[0] == 63.51709
+    assert N.isnan(lon[0])
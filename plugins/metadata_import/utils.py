@@ -1,29 +1,60 @@
-from IPython import embed
-import math
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
 
-def material_check(db, material):
-    '''Checks if material exists in database.
-        If passed material is new, it is added to vocabulary.material before the sample is updated.
+def chunks(seq, size):
+    """Split a list into lists of at most `size` items"""
+    for i in range(0, len(seq), size):
+        yield seq[i:i+size]
+
+def location_ewkt(location):
+    """GeoJSON-style point -> EWKT string"""
+    if location is None:
+        return None
+    #'SRID=4269;POINT(-71.064544 42.28787)'
+    lon, lat = location['coordinates']
+    return f"SRID=4269;POINT({lon} {lat})"
+
+def update_samples(db, updates):
+    '''Set material and location for existing samples, given as (sample id, sample dict)
+        pairs, in a single UPDATE statement.
+    '''
+    if len(updates) == 0:
+        return
+    values = []
+    params = {}
+    for i, (id, row) in enumerate(updates):
+        values.append(f"(CAST(:id_{i} AS integer), CAST(:material_{i} AS text), CAST(:location_{i} AS text))")
+        params[f"id_{i}"] = id
+        params[f"material_{i}"] = row['material']
+        params[f"location_{i}"] = location_ewkt(row['location'])
+
+    sql = f"""
+        UPDATE sample SET
+            material = v.material,
+            location = ST_GeomFromEWKT(v.location)
+        FROM (VALUES {", ".join(values)}) AS v(id, material, location)
+        WHERE sample.id = v.id
+    """
+    db.session.execute(text(sql), params)
+
+def is_material(material):
+    # some are None or nan
+    return material is not None and type(material) != float
+
+def ensure_materials(db, materials):
+    '''Makes sure that every passed material exists in vocabulary.material.
+        The vocabulary is loaded once, and new materials are added in a single statement
+        before any samples are loaded. Returns the new materials.
     '''
-    if material is None:
-        pass
-    elif type(material) == float:
-        # some are nan
-        pass
-    else:
-        Material = db.model.vocabulary_material    
-
-        current_materials = db.session.query(Material).all()
-
-        ## This has to happen otherwise the materials has ()'s and ""'s around it
-        current_material_list = []
-        for row in current_materials:
-            current_material_list.append(row.id)
-
-        if material not in current_material_list: 
-            mat = Material(id=material)
-            db.session.add(mat)
-            try:
-                db.session.commit()
-            except:
-                db.session.rollback()
+    Material = db.model.vocabulary_material
+
+    current_materials = {id for id, in db.session.query(Material.id)}
+    new_materials = sorted({m for m in materials if is_material(m)} - current_materials)
+
+    if len(new_materials) > 0:
+        stmt = (insert(Material.__table__)
+                .values([dict(id=m) for m in new_materials])
+                .on_conflict_do_nothing())
+        db.session.execute(stmt)
+        db.session.commit()
+    return new_materials
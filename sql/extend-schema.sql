@@ -2,16 +2,92 @@ INSERT INTO data_file_type (id) VALUES
   ('ETAgeCalc'),
   ('NuAgeCalc');
 
-/* Add a column for a cached CSV representation of data table
+/* Add a column for a cached representation of data table
   so we don't have to carry along the entire ETAgeCalc/
-  NuAgeCalc apparatus in memory */
+  NuAgeCalc apparatus in memory. Older rows hold CSV text;
+  newer rows hold compressed Arrow bytes (see datatable_cache.py) */
 ALTER TABLE data_file ADD COLUMN csv_data bytea;
 
+/* Normalized data tables and column metadata, cached so that
+  normalization runs once per file hash and normalizer version */
+ALTER TABLE data_file ADD COLUMN IF NOT EXISTS normalized_data bytea;
+ALTER TABLE data_file ADD COLUMN IF NOT EXISTS normalized_version integer;
+
+/* Why a data table could not be extracted, and the version of the
+  extractor that tried. Failed files are only downloaded again once
+  the extractor version changes (see data_import/workbooks.py) */
+ALTER TABLE data_file ADD COLUMN IF NOT EXISTS extract_error text;
+ALTER TABLE data_file ADD COLUMN IF NOT EXISTS extractor_version integer;
+
+/* Data files that failed to import, so that later imports can skip them
+  until the importer version changes (see data_import/failures.py) */
+CREATE TABLE IF NOT EXISTS data_file_failure (
+  file_hash uuid PRIMARY KEY REFERENCES data_file(file_hash) ON DELETE CASCADE,
+  error_class text NOT NULL,
+  message text,
+  importer_version integer NOT NULL,
+  failed timestamptz NOT NULL DEFAULT now()
+);
+
+/* Supports checking cloud object listings against already-extracted
+  files in bulk, before any object bodies are downloaded */
+CREATE INDEX IF NOT EXISTS data_file_object_manifest_idx
+  ON data_file (file_path, file_etag, file_mtime);
+
+/* Content hashes of metadata CSV rows, so that re-running the
+  metadata import only touches rows that changed (see provenance.py) */
+CREATE TABLE IF NOT EXISTS sample_metadata_import (
+  source_file text NOT NULL,
+  sample_name text NOT NULL,
+  occurrence integer NOT NULL DEFAULT 0,
+  sample_id integer REFERENCES sample(id) ON DELETE CASCADE,
+  row_hash text NOT NULL,
+  imported timestamptz NOT NULL DEFAULT now(),
+  PRIMARY KEY (source_file, sample_name, occurrence)
+);
+
+/* Indexes for the lookups made by the importers. `check-laserchron-indexes`
+  verifies that these are usable by the queries that need them. */
+-- `import_one` finds data files by basename
+CREATE INDEX IF NOT EXISTS data_file_basename_idx
+  ON data_file (basename);
+-- Data files for a session. Links by file hash are already indexed
+-- by core's unique constraints, which lead with `file_hash`.
+CREATE INDEX IF NOT EXISTS data_file_link_session_idx
+  ON data_file_link (session_id);
+-- The metadata importer matches samples by name
+CREATE INDEX IF NOT EXISTS sample_name_idx
+  ON sample (name);
+-- Age histograms select datum types by unit
+CREATE INDEX IF NOT EXISTS datum_type_unit_idx
+  ON datum_type (unit);
+
 -- Embargo permanantly by default
 ALTER TABLE project ALTER COLUMN embargo_date SET DEFAULT 'infinity';
 
-CREATE SCHEMA lab_view;
-CREATE OR REPLACE VIEW lab_view.aggregate_histogram AS
+CREATE SCHEMA IF NOT EXISTS lab_view;
+
+/* Supports scans of accepted datums by type, e.g. for histograms of ages */
+CREATE INDEX IF NOT EXISTS datum_accepted_type_idx
+  ON datum (type) INCLUDE (value)
+  WHERE is_accepted;
+
+/* The aggregate histogram backs the landing page, so it is materialized
+  rather than computed per request. It is refreshed after each
+  `import-laserchron` run (see data_import/lab_views.py). This used to
+  be a plain view, which has to be dropped first. */
+DO $$
+BEGIN
+  IF EXISTS (
+    SELECT 1 FROM pg_views
+    WHERE schemaname = 'lab_view'
+      AND viewname = 'aggregate_histogram'
+  ) THEN
+    DROP VIEW lab_view.aggregate_histogram;
+  END IF;
+END $$;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS lab_view.aggregate_histogram AS
 WITH a AS (
 SELECT
 	d.id,
@@ -35,3 +111,122 @@ SELECT
 	bucket*5 max_age,
 	count
 FROM b;
+
+/* Required to refresh the histogram concurrently */
+CREATE UNIQUE INDEX IF NOT EXISTS aggregate_histogram_min_age_idx
+  ON lab_view.aggregate_histogram (min_age);
+
+/* Accepted age counts per session, at several resolutions (in Ma), so that
+  histograms for any project or sample are an index lookup rather than a
+  scan of `datum`. Projects and samples are found through the session, so
+  that buckets follow sessions that are moved between them. Rows are
+  maintained by `import-laserchron` through `lab_view.refresh_age_buckets`. */
+CREATE TABLE IF NOT EXISTS lab_view.age_bucket (
+  session_id integer NOT NULL REFERENCES session(id) ON DELETE CASCADE,
+  resolution integer NOT NULL,
+  bucket integer NOT NULL,
+  count integer NOT NULL,
+  PRIMARY KEY (session_id, resolution, bucket)
+);
+
+CREATE INDEX IF NOT EXISTS age_bucket_resolution_idx
+  ON lab_view.age_bucket (resolution, bucket) INCLUDE (count);
+-- Sessions of a project or sample, for their histograms
+CREATE INDEX IF NOT EXISTS session_project_idx
+  ON session (project_id);
+CREATE INDEX IF NOT EXISTS session_sample_idx
+  ON session (sample_id);
+
+CREATE OR REPLACE FUNCTION lab_view.refresh_age_buckets(_session_id integer)
+RETURNS void AS $$
+  DELETE FROM lab_view.age_bucket WHERE session_id = _session_id;
+
+  INSERT INTO lab_view.age_bucket
+    (session_id, resolution, bucket, count)
+  SELECT
+    s.id,
+    r.resolution,
+    floor(d.value / r.resolution)::integer,
+    count(*)
+  FROM session s
+  JOIN analysis a
+    ON a.session_id = s.id
+  JOIN datum d
+    ON d.analysis = a.id
+  JOIN datum_type dt
+    ON d.type = dt.id
+  CROSS JOIN (VALUES (1), (5), (25)) r(resolution)
+  WHERE s.id = _session_id
+    AND d.is_accepted
+    AND dt.unit = 'Ma'
+    AND d.value IS NOT NULL
+  GROUP BY s.id, r.resolution, floor(d.value / r.resolution);
+$$ LANGUAGE sql;
+
+/* Histogram of accepted ages, optionally for a single project or sample.
+  Resolutions that are not stored are built from the coarsest stored
+  resolution that divides them. Buckets cover [min_age, max_age). */
+CREATE OR REPLACE FUNCTION lab_view.age_histogram(
+  _resolution integer DEFAULT 5,
+  _project_id integer DEFAULT NULL,
+  _sample_id integer DEFAULT NULL
+)
+RETURNS TABLE (min_age integer, max_age integer, count bigint) AS $$
+#variable_conflict use_column
+BEGIN
+  IF _resolution IS NULL OR _resolution <= 0 THEN
+    RAISE EXCEPTION 'Histogram resolution must be a positive number of Ma, not %', _resolution;
+  END IF;
+
+  RETURN QUERY
+  WITH base AS (
+    SELECT CASE
+      WHEN _resolution % 25 = 0 THEN 25
+      WHEN _resolution % 5 = 0 THEN 5
+      ELSE 1
+    END AS resolution
+  ),
+  b AS (
+    SELECT
+      floor(ab.bucket * base.resolution / _resolution::numeric)::integer AS bucket,
+      sum(ab.count) AS count
+    FROM lab_view.age_bucket ab
+    JOIN base
+      ON ab.resolution = base.resolution
+    JOIN session s
+      ON s.id = ab.session_id
+    WHERE (_project_id IS NULL OR s.project_id = _project_id)
+      AND (_sample_id IS NULL OR s.sample_id = _sample_id)
+    GROUP BY 1
+  )
+  SELECT
+    b.bucket * _resolution,
+    (b.bucket + 1) * _resolution,
+    b.count::bigint
+  FROM b
+  ORDER BY b.bucket;
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+CREATE OR REPLACE FUNCTION lab_view.project_age_histogram(
+  _project_id integer,
+  _resolution integer DEFAULT 5
+)
+RETURNS TABLE (min_age integer, max_age integer, count bigint) AS $$
+  SELECT * FROM lab_view.age_histogram(_resolution, _project_id => _project_id);
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION lab_view.sample_age_histogram(
+  _sample_id integer,
+  _resolution integer DEFAULT 5
+)
+RETURNS TABLE (min_age integer, max_age integer, count bigint) AS $$
+  SELECT * FROM lab_view.age_histogram(_resolution, _sample_id => _sample_id);
+$$ LANGUAGE sql STABLE;
+
+/* Fill in buckets for sessions imported before the table existed */
+SELECT lab_view.refresh_age_buckets(s.id)
+FROM session s
+WHERE NOT EXISTS (
+  SELECT 1 FROM lab_view.age_bucket ab WHERE ab.session_id = s.id
+);